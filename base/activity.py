@@ -0,0 +1,97 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+
+from .broadcast import encode_frame
+from .models import Message, Room, RoomMembership, User
+from .utils import message_page, encode_cursor
+
+ACTIVITY_PAGE_SIZE = getattr(settings, 'CLUST_ACTIVITY_PAGE_SIZE', 30)
+ACTIVITY_CACHE_TIMEOUT = getattr(settings, 'CLUST_ACTIVITY_CACHE_TIMEOUT', 5 * 60)
+
+PUBLIC_GROUP = 'activity_public'
+VERSION_KEY = 'clust:activity:version'
+
+
+def room_group(room_id):
+    return f'activity_room_{room_id}'
+
+
+def visible_messages(user):
+    messages = Message.objects.select_related('room')
+    if not user.is_authenticated:
+        return messages.filter(room__is_private=False)
+    is_member = RoomMembership.objects.filter(
+        room=OuterRef('room_id'), user=user, role__in=['ADMIN', 'MEMBER']
+    )
+    return messages.filter(Q(room__is_private=False) | Q(Exists(is_member)))
+
+
+def activity_page(user, before=None):
+    return message_page(visible_messages(user), before=before, limit=ACTIVITY_PAGE_SIZE)
+
+
+def first_page(user):
+    # Cached per user; saving any message bumps the version and so
+    # invalidates every user's first page at once
+    version = cache.get_or_set(VERSION_KEY, 1, None)
+    key = f'clust:activity:{version}:{user.id or 0}'
+    page = cache.get(key)
+    if page is None:
+        page = activity_page(user)
+        cache.set(key, page, ACTIVITY_CACHE_TIMEOUT)
+    return page
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+def serialize(message, username, room_name):
+    return {
+        'id': message.id,
+        'user_id': message.user_id,
+        'username': username,
+        'room_id': message.room_id,
+        'room_name': room_name,
+        'body': message.body,
+        'created': message.created.isoformat(),
+        'cursor': encode_cursor(message),
+    }
+
+
+def publish(messages):
+    channel_layer = get_channel_layer()
+    if channel_layer is None or not messages:
+        return
+    # Messages saved by views carry their user and room, bulk-created ones only ids
+    user_field = Message._meta.get_field('user')
+    room_field = Message._meta.get_field('room')
+    missing_users = {m.user_id for m in messages if not user_field.is_cached(m)}
+    missing_rooms = {m.room_id for m in messages if not room_field.is_cached(m)}
+    usernames = dict(User.objects.filter(id__in=missing_users).values_list('id', 'username')) \
+        if missing_users else {}
+    rooms = {room_id: (name, is_private) for room_id, name, is_private in
+             Room.objects.filter(id__in=missing_rooms).values_list('id', 'name', 'is_private')} \
+        if missing_rooms else {}
+
+    for message in messages:
+        username = message.user.username if user_field.is_cached(message) else usernames.get(message.user_id)
+        if room_field.is_cached(message):
+            room_name, is_private = message.room.name, message.room.is_private
+        elif message.room_id in rooms:
+            room_name, is_private = rooms[message.room_id]
+        else:
+            continue
+        frame = encode_frame(serialize(message, username, room_name))
+        if is_private:
+            # Lets consumers re-check access, room groups are picked at connect
+            frame['room_id'] = message.room_id
+        async_to_sync(channel_layer.group_send)(
+            room_group(message.room_id) if is_private else PUBLIC_GROUP, frame
+        )
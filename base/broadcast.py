@@ -0,0 +1,16 @@
+import json
+
+
+def encode_frame(payload):
+    # Group event carrying an already encoded frame. It is serialized once by
+    # the sender, every consumer in the group just forwards the text.
+    return {'type': 'broadcast', 'text': json.dumps(payload)}
+
+
+class BroadcastMixin:
+    async def broadcast(self, event):
+        # Frames may also carry a binary encoding for compact protocol sockets
+        if 'bytes' in event and getattr(self, 'compact', False):
+            await self.send(bytes_data=event['bytes'])
+        else:
+            await self.send(text_data=event['text'])
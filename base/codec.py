@@ -0,0 +1,57 @@
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# CodeSnippets rows store their text either plain in code_diff (codec '',
+# every row written before compression existed) or compressed in code_blob
+PLAIN = ''
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+
+CODE_CODEC = getattr(settings, 'CLUST_CODE_CODEC', ZSTD if zstandard else ZLIB)
+# Short patches do not shrink enough to pay for the decompression
+CODE_COMPRESS_MIN_BYTES = getattr(settings, 'CLUST_CODE_COMPRESS_MIN_BYTES', 256)
+
+
+def compress(data, codec):
+    if codec == ZLIB:
+        return zlib.compress(data, 6)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError('zstandard is not installed')
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    raise ValueError(f'unknown codec {codec!r}')
+
+
+def decompress(data, codec):
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError('zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f'unknown codec {codec!r}')
+
+
+def encode(text, codec=None):
+    # Returns the (codec, code_diff, code_blob) column values for text
+    codec = CODE_CODEC if codec is None else codec
+    raw = text.encode()
+    if codec == PLAIN or len(raw) < CODE_COMPRESS_MIN_BYTES:
+        return PLAIN, text, None
+    blob = compress(raw, codec)
+    if len(blob) >= len(raw):
+        return PLAIN, text, None
+    return codec, '', blob
+
+
+def decode(codec, code_diff, code_blob):
+    if codec == PLAIN:
+        return code_diff
+    # memoryview on some backends
+    return decompress(bytes(code_blob), codec).decode()
@@ -1,61 +1,188 @@
 import json
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import User, Room, Message
-class ChatConsumer(AsyncWebsocketConsumer):
+from channels.layers import get_channel_layer
+from .models import Room, RoomMembership
+from . import activity, metrics, permissions
+from .broadcast import BroadcastMixin, encode_frame
+from .presence import presence, presence_groups
+from .documents import open_document, close_document, open_documents, StaleOperation
+from .writebehind import message_writer
+from .wire import COMPACT_PROTOCOL, WireError, clean_client_id, encode_code_batch, decode_client_frame
+
+GROUP_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+logger = logging.getLogger(__name__)
+
+
+@metrics.timed_database_sync_to_async
+def can_view_room(user, room_id):
+    # Served from base.permissions' cache, so reconnects cost no queries
+    return permissions.can_view(permissions.room_access(user, room_id))
+
+
+@metrics.timed_database_sync_to_async
+def private_room_ids(user):
+    return list(
+        RoomMembership.objects
+        .filter(user=user, role__in=['ADMIN', 'MEMBER'], room__is_private=True)
+        .values_list('room_id', flat=True)
+    )
+
+
+@metrics.timed_database_sync_to_async
+def add_participant(room_id, user_id):
+    Room.participants.through.objects.get_or_create(room_id=room_id, user_id=user_id)
+
+
+async def broadcast_presence(room_id, joined=(), left=()):
+    channel_layer = get_channel_layer()
+    frame = encode_frame({
+        'type': 'presence',
+        'online': presence.online(room_id),
+        'joined': list(joined),
+        'left': list(left),
+    })
+    for group in presence_groups(room_id):
+        await metrics.group_send(channel_layer, group, frame, 'presence')
+
+
+@metrics.register_collector
+def collect_group_sizes():
+    # Sockets per room, from state the consumers keep anyway
+    return [
+        ('clust_room_group_size', 'histogram', 'Code page sockets per open room document.', metrics.histogram_samples(
+            [document.connections for document in open_documents()], GROUP_SIZE_BUCKETS)),
+        ('clust_presence_group_size', 'histogram', 'Online sockets per room, chat and code pages.',
+         metrics.histogram_samples(presence.socket_counts(), GROUP_SIZE_BUCKETS)),
+        ('clust_open_documents', 'gauge', 'Room documents held in memory.',
+         [('', {}, len(open_documents()))]),
+    ]
+
+
+async def expire_presence(room_id, entry):
+    await broadcast_presence(room_id, left=[{'id': entry['id'], 'username': entry['username']}])
+
+
+class PresenceMixin:
+    # Online tracking shared by the chat and code consumers. Reads come from
+    # memory; Room.participants is only written on a user's first message
+    # over a connection, and only if they are not a participant yet.
+    async def presence_join(self, room_id):
+        self.participating = False
+        if self.user and self.user.is_authenticated:
+            if presence.join(room_id, self.channel_name, self.user):
+                await broadcast_presence(
+                    room_id, joined=[{'id': self.user.id, 'username': self.user.username}])
+            presence.start_sweeper(expire_presence)
+        await self.send(text_data=json.dumps({
+            'type': 'presence',
+            'online': presence.online(room_id),
+            'joined': [],
+            'left': [],
+        }))
+
+    async def presence_touch(self, room_id):
+        if presence.touch(room_id, self.channel_name, self.user):
+            await broadcast_presence(
+                room_id, joined=[{'id': self.user.id, 'username': self.user.username}])
+            presence.start_sweeper(expire_presence)
+
+    async def presence_leave(self, room_id):
+        entry = presence.leave(room_id, self.channel_name)
+        if entry is not None:
+            await broadcast_presence(room_id, left=[{'id': entry['id'], 'username': entry['username']}])
+
+    async def participate(self, room_id):
+        if not self.participating:
+            self.participating = True
+            await add_participant(room_id, self.user.id)
+
+
+class ChatConsumer(PresenceMixin, BroadcastMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
+        self.room_id = int(self.scope['url_route']['kwargs']['room_id'])
         self.room_group_name = f'chat_{self.room_id}'
+        # Resolved once here; messages are always posted as the session user
+        self.user = self.scope.get('user')
+        self.joined = False
+
+        if not await can_view_room(self.user, self.room_id):
+            metrics.WEBSOCKET_CONNECTS.inc('chat', 'rejected')
+            await self.close()
+            return
 
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        self.joined = True
         await self.accept()
+        metrics.WEBSOCKET_CONNECTS.inc('chat', 'accepted')
+        metrics.WEBSOCKET_CONNECTIONS.inc('chat')
+        await self.presence_join(self.room_id)
 
     async def disconnect(self, close_code):
+        if not self.joined:
+            return
+        metrics.WEBSOCKET_CONNECTIONS.dec('chat')
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.presence_leave(self.room_id)
 
     async def receive(self, text_data):
         # Receive message from WebSocket
         data = json.loads(text_data)
+        metrics.WEBSOCKET_MESSAGES.inc('chat', data.get('type') or 'chat_message')
+        if data.get('type') == 'heartbeat':
+            await self.presence_touch(self.room_id)
+            return
         message = data.get('message')
-        username = data.get('username')
-        room_name = self.room_id
-        await self.save_message(username, room_name, message)
+        # Anonymous sockets can read the room but not post to it
+        if not self.user or not self.user.is_authenticated or not message:
+            return
+        await self.presence_touch(self.room_id)
+        await self.participate(self.room_id)
 
-        # Send message to room group
-        await self.channel_layer.group_send(
+        # Send message to room group, then hand it to the write-behind queue
+        await metrics.group_send(
+            self.channel_layer,
             self.room_group_name,
-            {
-                'type': 'chat_message',
+            encode_frame({
                 'message': message,
-                'username': username
-            }
+                'username': self.user.username
+            }),
+            'chat'
         )
+        metrics.CHAT_MESSAGES.inc('chat')
+        await message_writer.enqueue(self.user.id, self.room_id, message)
 
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': event['message'],
-            'username': event['username']
-        }))
-    @database_sync_to_async
-    def save_message(self, username, room, message):
-        user = User.objects.get(username=username)
-        room = Room.objects.get(id=room)
-        return Message.objects.create(user=user, room=room, body=message)
-    
-class RoomConsumer(AsyncWebsocketConsumer):
+
+class RoomConsumer(PresenceMixin, BroadcastMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Get room name from the URL
-        self.room_name = self.scope['url_route']['kwargs']['room_id']
+        self.room_name = int(self.scope['url_route']['kwargs']['room_id'])
         self.room_group_name = f'room_{self.room_name}'
+        self.user = self.scope.get('user')
+        self.document = None
+        # Clients opt into binary code frames through the websocket subprotocol
+        self.compact = COMPACT_PROTOCOL in self.scope.get('subprotocols', [])
+        self.client_id = None
+
+        if not await can_view_room(self.user, self.room_name):
+            metrics.WEBSOCKET_CONNECTS.inc('room', 'rejected')
+            await self.close()
+            return
+        try:
+            self.document = await open_document(self.room_name)
+        except Room.DoesNotExist:
+            metrics.WEBSOCKET_CONNECTS.inc('room', 'rejected')
+            await self.close()
+            return
 
         # Join the room group
         await self.channel_layer.group_add(
@@ -63,59 +190,158 @@ class RoomConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        if self.compact:
+            self.document.compact_connections += 1
+            await self.accept(subprotocol=COMPACT_PROTOCOL)
+        else:
+            await self.accept()
+        metrics.WEBSOCKET_CONNECTS.inc('room', 'accepted')
+        metrics.WEBSOCKET_CONNECTIONS.inc('room')
+        # Late joiners get the current document straight from memory
+        await self.send_code_sync()
+        await self.presence_join(self.room_name)
 
     async def disconnect(self, close_code):
+        if self.document is None:
+            return
+        metrics.WEBSOCKET_CONNECTIONS.dec('room')
         # Leave the room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.presence_leave(self.room_name)
+        if self.compact:
+            self.document.compact_connections -= 1
+        await close_document(self.document)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            metrics.WEBSOCKET_MESSAGES.inc('room', 'compact')
+            await self.receive_compact(bytes_data)
+            return
         # Parse the incoming WebSocket message
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type')
-        username = text_data_json.get('username')
+        metrics.WEBSOCKET_MESSAGES.inc('room', message_type or 'unknown')
+
+        if message_type == 'code_sync':
+            await self.send_code_sync()
+            return
+        # Only the session user may post or edit, never a client-supplied name
+        if not self.user or not self.user.is_authenticated:
+            return
+        username = self.user.username
+        await self.presence_touch(self.room_name)
+
+        if message_type == 'heartbeat':
+            return
 
         if message_type == 'chat_message':
             message = text_data_json.get('message')
+            await self.participate(self.room_name)
 
             # Broadcast chat message to the room group
-            await self.channel_layer.group_send(
+            await metrics.group_send(
+                self.channel_layer,
                 self.room_group_name,
-                {
+                encode_frame({
                     'type': 'chat_message',
                     'username': username,
                     'message': message
-                }
+                }),
+                'chat'
             )
+            metrics.CHAT_MESSAGES.inc('room')
+            await message_writer.enqueue(self.user.id, self.room_name, message)
 
         elif message_type == 'code_change':
-            code = text_data_json.get('code')
+            change = text_data_json.get('code')
+            if not isinstance(change, dict):
+                return
+            change['clientId'] = clean_client_id(change.get('clientId'))
+            await self.apply_code_change(change, text_data_json.get('seq'))
 
-            # Broadcast code change to the room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'code_change',
-                    'username': username,
-                    'code': code
-                }
-            )
+    async def receive_compact(self, bytes_data):
+        if not self.user or not self.user.is_authenticated:
+            return
+        try:
+            frame = decode_client_frame(bytes_data)
+        except (WireError, UnicodeDecodeError):
+            return
+        await self.presence_touch(self.room_name)
+        if frame[0] == 'hello':
+            self.client_id = frame[1]
+        else:
+            _, base_seq, change = frame
+            change['clientId'] = self.client_id
+            await self.apply_code_change(change, base_seq)
+
+    async def apply_code_change(self, change, base_seq):
+        try:
+            code = self.document.apply(change, base_seq)
+        except (StaleOperation, TypeError, ValueError):
+            # Client is too far behind to transform its op, resend the document
+            await self.send_code_sync()
+            return
+        self.document.schedule_checkpoint()
+        metrics.CODE_OPS.inc()
+        code['username'] = self.user.username
+
+        # Ops from everyone in the room go out together once per tick
+        await self.document.queue_broadcast(code, self.send_code_frame)
 
-    async def chat_message(self, event):
-        # Send chat message to WebSocket
+    async def send_code_frame(self, ops):
+        frame = encode_frame({
+            'type': 'code_batch',
+            'ops': ops
+        })
+        if self.document.compact_connections:
+            try:
+                frame['bytes'] = encode_code_batch(ops, self.document.interned)
+            except WireError:
+                # Compact sockets take the JSON text of this batch instead
+                logger.warning('Sending code_batch for room %s as JSON only', self.room_name, exc_info=True)
+        await metrics.group_send(self.channel_layer, self.room_group_name, frame, 'code')
+
+    async def send_code_sync(self):
+        snapshot = self.document.snapshot()
+        if self.compact:
+            snapshot['interned'] = self.document.interned.strings
         await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'username': event['username'],
-            'message': event['message']
+            'type': 'code_sync',
+            **snapshot
         }))
 
-    async def code_change(self, event):
-        # Send code change to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'code_change',
-            'username': event['username'],
-            'code': event['code']
-        }))
\ No newline at end of file
+
+class ActivityConsumer(BroadcastMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        # Public activity plus the private rooms this user belongs to, so
+        # every pushed item is already one the viewer may see
+        self.groups_joined = [activity.PUBLIC_GROUP]
+        user = self.scope.get('user')
+        if user and user.is_authenticated:
+            self.groups_joined += [
+                activity.room_group(room_id) for room_id in await private_room_ids(user)
+            ]
+        for group in self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for group in getattr(self, 'groups_joined', []):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def broadcast(self, event):
+        # Private room items are only sent while the user may still see the
+        # room; a revoked member leaves its group on the first one
+        room_id = event.get('room_id')
+        if room_id is not None:
+            access = await permissions.aroom_access(self.scope.get('user'), room_id)
+            if not permissions.can_view(access):
+                group = activity.room_group(room_id)
+                if group in self.groups_joined:
+                    self.groups_joined.remove(group)
+                await self.channel_layer.group_discard(group, self.channel_name)
+                return
+        await super().broadcast(event)
@@ -0,0 +1,206 @@
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import timed_database_sync_to_async
+from .models import Room, CodeSnippets
+from .utils import reconstruct_code, store_code_version
+from .wire import InternTable
+
+# Seconds to wait after the last edit before writing a CodeSnippets version
+CHECKPOINT_DELAY = getattr(settings, 'CLUST_CODE_CHECKPOINT_DELAY', 5.0)
+# How many applied ops are kept around to transform late (concurrent) ops
+OP_LOG_SIZE = getattr(settings, 'CLUST_CODE_OP_LOG_SIZE', 500)
+# Ops applied within this many seconds go out to the room as one frame;
+# 0 broadcasts every op on its own
+BATCH_TICK = getattr(settings, 'CLUST_CODE_BATCH_TICK', 0.03)
+
+
+class StaleOperation(Exception):
+    pass
+
+
+def pos_to_index(text, pos):
+    # CodeMirror positions are {line, ch}; convert to a flat string offset
+    line = max(int(pos.get('line', 0)), 0)
+    ch = max(int(pos.get('ch', 0)), 0)
+    index = 0
+    for _ in range(line):
+        newline = text.find('\n', index)
+        if newline == -1:
+            return len(text)
+        index = newline + 1
+    line_end = text.find('\n', index)
+    if line_end == -1:
+        line_end = len(text)
+    return min(index + ch, line_end)
+
+
+def index_to_pos(text, index):
+    line = text.count('\n', 0, index)
+    line_start = text.rfind('\n', 0, index) + 1
+    return {'line': line, 'ch': index - line_start}
+
+
+def transform_index(index, op):
+    # Map an offset through an already applied op (start, end, inserted text, ...)
+    start, end, inserted = op[:3]
+    if index < start:
+        return index
+    if index >= end:
+        return index + len(inserted) - (end - start)
+    return start + len(inserted)
+
+
+def undo_op(text, op):
+    # Text before an applied op (start, end, inserted text, removed text)
+    start, end, inserted, removed = op
+    return text[:start] + removed + text[start + len(inserted):]
+
+
+class RoomDocument:
+    def __init__(self, room_id, text=''):
+        self.room_id = room_id
+        self.text = text
+        self.seq = 0
+        self.saved_seq = 0
+        self.log = deque(maxlen=OP_LOG_SIZE)
+        self.connections = 0
+        self._checkpoint_task = None
+        self._save_lock = asyncio.Lock()
+        self.pending = []
+        self._frame_task = None
+        # Only rooms with compact protocol sockets pay for binary frames
+        self.compact_connections = 0
+        self.interned = InternTable()
+
+    def snapshot(self):
+        return {'code': self.text, 'seq': self.seq}
+
+    def apply(self, change, base_seq=None):
+        if base_seq is None:
+            base_seq = self.seq
+        if base_seq > self.seq or (
+                base_seq < self.seq and (not self.log or self.log[0][0] > base_seq + 1)):
+            raise StaleOperation()
+
+        # Ops the client had not seen yet were applied first. Its positions
+        # refer to the document before them, so resolve them there and then
+        # shift the offsets past those ops.
+        later = [applied for seq, applied in self.log if seq > base_seq] if base_seq < self.seq else []
+        base_text = self.text
+        for applied in reversed(later):
+            base_text = undo_op(base_text, applied)
+
+        start = pos_to_index(base_text, change.get('from') or {})
+        end = pos_to_index(base_text, change.get('to') or {})
+        if end < start:
+            start, end = end, start
+        inserted = '\n'.join(change.get('text') or [])
+
+        for applied in later:
+            start = transform_index(start, applied)
+            end = max(transform_index(end, applied), start)
+
+        op = {
+            'from': index_to_pos(self.text, start),
+            'to': index_to_pos(self.text, end),
+            'text': change.get('text') or [''],
+            'origin': change.get('origin'),
+            'clientId': change.get('clientId'),
+        }
+        removed = self.text[start:end]
+        self.text = self.text[:start] + inserted + self.text[end:]
+        self.seq += 1
+        self.log.append((self.seq, (start, end, inserted, removed)))
+        op['seq'] = self.seq
+        return op
+
+    async def queue_broadcast(self, op, send_frame):
+        # Collect ops for one tick and hand them to send_frame in seq order
+        self.pending.append(op)
+        if BATCH_TICK <= 0:
+            await self._send_pending(send_frame)
+        elif self._frame_task is None or self._frame_task.done():
+            self._frame_task = asyncio.ensure_future(self._delayed_frame(send_frame))
+
+    async def _delayed_frame(self, send_frame):
+        await asyncio.sleep(BATCH_TICK)
+        await self._send_pending(send_frame)
+
+    async def _send_pending(self, send_frame):
+        ops, self.pending = self.pending, []
+        if ops:
+            await send_frame(ops)
+
+    def schedule_checkpoint(self):
+        if self._checkpoint_task is None or self._checkpoint_task.done():
+            self._checkpoint_task = asyncio.ensure_future(self._delayed_checkpoint())
+
+    async def _delayed_checkpoint(self):
+        await asyncio.sleep(CHECKPOINT_DELAY)
+        await self.checkpoint()
+
+    async def checkpoint(self):
+        async with self._save_lock:
+            if self.saved_seq == self.seq:
+                return
+            seq, text = self.seq, self.text
+            await timed_database_sync_to_async(save_document)(self.room_id, text)
+            self.saved_seq = seq
+
+
+def load_document_text(room_id):
+    room = Room.objects.get(id=room_id)
+    try:
+        return reconstruct_code(room)
+    except CodeSnippets.DoesNotExist:
+        return ''
+
+
+def save_document(room_id, text):
+    room = Room.objects.get(id=room_id)
+    return store_code_version(room, text)
+
+
+_documents = {}
+_loading = {}
+
+
+async def open_document(room_id):
+    room_id = int(room_id)
+    document = _documents.get(room_id)
+    if document is None:
+        # Several sockets may join an unloaded room at once; load it only once
+        loading = _loading.get(room_id)
+        if loading is None:
+            loading = asyncio.ensure_future(
+                timed_database_sync_to_async(load_document_text)(room_id))
+            _loading[room_id] = loading
+        try:
+            text = await asyncio.shield(loading)
+        finally:
+            _loading.pop(room_id, None)
+        document = _documents.setdefault(room_id, RoomDocument(room_id, text))
+    document.connections += 1
+    return document
+
+
+async def close_document(document):
+    document.connections -= 1
+    if document.connections > 0:
+        return
+    # Last editor left: persist what we have, then drop the in-memory copy
+    # unless someone rejoined while the checkpoint was being written
+    await document.checkpoint()
+    if document.connections == 0 and _documents.get(document.room_id) is document:
+        del _documents[document.room_id]
+
+
+def open_documents():
+    return list(_documents.values())
+
+
+def get_document(room_id):
+    return _documents.get(int(room_id))
@@ -0,0 +1,153 @@
+import csv
+import io
+
+from django.conf import settings
+from django.contrib.auth.models import BaseUserManager
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from .mailqueue import invitation_mailer
+from .models import INVITATION_LIFETIME, RoomInvitation, RoomMembership, User
+from .signals import memberships_created
+
+# Addresses accepted by one bulk request, after de-duplication
+BULK_INVITE_LIMIT = getattr(settings, 'CLUST_BULK_INVITE_LIMIT', 1000)
+# Membership inserts retried when someone joins during an import
+BULK_RETRIES = 3
+
+
+class TooManyEmails(ValueError):
+    pass
+
+
+def split_emails(text):
+    # Pasted lists: one address per line, or separated by commas, semicolons
+    # or spaces
+    for separator in ',;':
+        text = text.replace(separator, ' ')
+    return text.split()
+
+
+def read_csv_emails(upload):
+    # The column headed "email" when there is one, otherwise the first column
+    reader = csv.reader(io.TextIOWrapper(upload, encoding='utf-8-sig', errors='replace'))
+    rows = [row for row in reader if any(cell.strip() for cell in row)]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    if 'email' in header:
+        column = header.index('email')
+        rows = rows[1:]
+    else:
+        column = 0
+    return [row[column] for row in rows if len(row) > column]
+
+
+def clean_emails(emails):
+    # (valid addresses in input order without repeats, invalid entries).
+    # Repeats are found ignoring case, like classify matches addresses.
+    valid, invalid, seen = [], [], set()
+    for email in emails:
+        email = BaseUserManager.normalize_email(email.strip())
+        if not email or email.lower() in seen:
+            continue
+        seen.add(email.lower())
+        try:
+            validate_email(email)
+        except ValidationError:
+            invalid.append(email)
+        else:
+            valid.append(email)
+    if len(valid) > BULK_INVITE_LIMIT:
+        raise TooManyEmails(f"At most {BULK_INVITE_LIMIT} addresses per request")
+    return valid, invalid
+
+
+def classify(room, emails):
+    # One query for everything already known about these addresses: who is
+    # a member, who has a pending invitation and who has an account.
+    # Addresses match ignoring case. Returns {lowercased email: {kind:
+    # (id, stored email)}} with kind 'member', 'pending' or 'user'.
+    lowered = [email.lower() for email in emails]
+    kind = lambda name: Value(name, output_field=CharField())
+    members = RoomMembership.objects.filter(room=room) \
+        .annotate(address=Lower('user__email')).filter(address__in=lowered) \
+        .values_list('address', kind('member'), 'user_id', 'user__email')
+    pending = RoomInvitation.objects.filter(room=room, is_used=False, expires_at__gt=timezone.now()) \
+        .annotate(address=Lower('email')).filter(address__in=lowered) \
+        .values_list('address', kind('pending'), 'id', 'email')
+    users = User.objects.annotate(address=Lower('email')).filter(address__in=lowered) \
+        .values_list('address', kind('user'), 'id', 'email')
+    known = {}
+    for address, name, pk, stored in members.union(pending, users, all=True):
+        known.setdefault(address, {})[name] = (pk, stored)
+    return known
+
+
+def bulk_invite(room, inviter, emails, base_url, add_existing=False):
+    # Invites every address that is not a member and has no pending
+    # invitation. With add_existing, addresses that already have an account
+    # become members straight away instead of being invited.
+    valid, invalid = clean_emails(emails)
+    known = classify(room, valid) if valid else {}
+    result = {'invited': [], 'added': [], 'members': [], 'pending': [], 'invalid': invalid}
+    invitations, memberships = [], {}
+    expires_at = timezone.now() + INVITATION_LIFETIME
+    for email in valid:
+        kinds = known.get(email.lower(), {})
+        if 'member' in kinds:
+            result['members'].append(email)
+        elif add_existing and 'user' in kinds:
+            user_id, _ = kinds['user']
+            memberships[user_id] = (email, RoomMembership(
+                user_id=user_id, room=room, role='MEMBER', invited_by=inviter))
+        elif 'pending' in kinds:
+            result['pending'].append(email)
+        else:
+            result['invited'].append(email)
+            # join_room compares the account's address exactly, so invite
+            # an existing account under the address it was registered with
+            address = kinds['user'][1] if 'user' in kinds else email
+            invitations.append(RoomInvitation(
+                room=room, email=address, created_by=inviter, expires_at=expires_at))
+
+    with transaction.atomic():
+        # bulk_create skips save() and post_save: expiry is set above and
+        # the permission cache is told about the memberships by signal
+        RoomInvitation.objects.bulk_create(invitations)
+        added = add_memberships(room, memberships, result)
+        if added:
+            transaction.on_commit(lambda: memberships_created.send(
+                sender=RoomMembership, room_id=room.id, user_ids=added))
+        if invitations:
+            invitation_ids = [invitation.id for invitation in invitations]
+            if None in invitation_ids:
+                # Backends that cannot return ids from a bulk insert
+                invitation_ids = list(RoomInvitation.objects.filter(
+                    token__in=[invitation.token for invitation in invitations]
+                ).values_list('id', flat=True))
+            invitation_mailer.enqueue_on_commit(invitation_ids, base_url)
+    return result
+
+
+def add_memberships(room, memberships, result):
+    # memberships is {user id: (email, RoomMembership)}. Users who joined
+    # since classify ran make the insert fail; they are reported as
+    # members and the rest inserted again. Returns the user ids added.
+    for _ in range(BULK_RETRIES):
+        try:
+            with transaction.atomic():
+                RoomMembership.objects.bulk_create([membership for _, membership in memberships.values()])
+        except IntegrityError:
+            joined = RoomMembership.objects.filter(room=room, user_id__in=memberships) \
+                .values_list('user_id', flat=True)
+            for user_id in joined:
+                result['members'].append(memberships.pop(user_id)[0])
+            continue
+        result['added'] += [email for email, _ in memberships.values()]
+        return list(memberships)
+    raise IntegrityError('memberships kept changing during a bulk import')
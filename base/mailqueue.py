@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import RoomInvitation
+
+# Invitations sent over one SMTP connection
+BATCH_SIZE = getattr(settings, 'CLUST_INVITATION_BATCH_SIZE', 50)
+# Attempts per invitation before it is marked FAILED
+MAX_ATTEMPTS = getattr(settings, 'CLUST_INVITATION_MAX_ATTEMPTS', 5)
+# Seconds before the first retry, doubled for every retry after that
+RETRY_DELAY = getattr(settings, 'CLUST_INVITATION_RETRY_DELAY', 30)
+WORKERS = getattr(settings, 'CLUST_INVITATION_WORKERS', 1)
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts, base=RETRY_DELAY):
+    return base * 2 ** (attempts - 1)
+
+
+class InvitationMailer:
+    # Per-process outbound queue for invitation emails. Views enqueue on
+    # commit; worker threads take due invitations in batches, send each batch
+    # over one connection and record the outcome on the invitation row.
+    # Retries wait in memory, rows left QUEUED or RETRYING after a restart
+    # are picked up by the send_invitation_emails command.
+    def __init__(self, batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS,
+                 retry_delay=RETRY_DELAY, workers=WORKERS, background=True):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.workers = workers
+        # Without background workers nothing is sent until flush() is called
+        self.background = background
+        # (due, seq, invitation_id, base_url)
+        self._pending = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.batches = 0
+
+    def enqueue(self, invitation_ids, base_url, due=None):
+        due = time.monotonic() if due is None else due
+        with self._cond:
+            for invitation_id in invitation_ids:
+                heapq.heappush(self._pending, (due, next(self._seq), invitation_id, base_url))
+            self._cond.notify(len(invitation_ids))
+        if self.background:
+            self._start()
+
+    def enqueue_on_commit(self, invitation_ids, base_url):
+        invitation_ids = list(invitation_ids)
+        transaction.on_commit(lambda: self.enqueue(invitation_ids, base_url))
+
+    def _start(self):
+        with self._cond:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='clust-invitation-mailer', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _take(self, wait):
+        # Up to batch_size invitations that are due, waiting for the first
+        # one when `wait` is set
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._pending and self._pending[0][0] <= now:
+                    break
+                if not wait:
+                    return []
+                self._cond.wait(self._pending[0][0] - now if self._pending else None)
+            batch = []
+            while self._pending and self._pending[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._pending))
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take(wait=True)
+            close_old_connections()
+            try:
+                self.deliver(batch)
+            except Exception:
+                # Database trouble: nothing was recorded, so try again later
+                logger.exception('Failed to deliver %d invitation emails', len(batch))
+                self._reschedule(batch, self.retry_delay)
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        # Deliver everything that is due in the calling thread
+        while True:
+            batch = self._take(wait=False)
+            if not batch:
+                return
+            self.deliver(batch)
+
+    def _reschedule(self, batch, delay):
+        due = time.monotonic() + delay
+        with self._cond:
+            for _, _, invitation_id, base_url in batch:
+                heapq.heappush(self._pending, (due, next(self._seq), invitation_id, base_url))
+            self._cond.notify(len(batch))
+
+    def deliver(self, batch):
+        base_urls = {invitation_id: base_url for _, _, invitation_id, base_url in batch}
+        invitations = list(
+            RoomInvitation.objects
+            .filter(id__in=base_urls, email_status__in=['QUEUED', 'RETRYING'])
+            .select_related('room', 'created_by')
+        )
+        if not invitations:
+            return
+        self.batches += 1
+        outcomes = []
+        # One connection for the whole batch. Messages go one by one so a
+        # rejected recipient only fails its own invitation.
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+            for invitation in invitations:
+                try:
+                    message = invitation.invitation_email(base_urls[invitation.id], connection)
+                    connection.send_messages([message])
+                except Exception as exc:
+                    outcomes.append((invitation, exc))
+                else:
+                    outcomes.append((invitation, None))
+        except Exception as exc:
+            # The connection itself failed; everything not sent yet retries
+            done = {invitation.id for invitation, _ in outcomes}
+            outcomes += [(invitation, exc) for invitation in invitations if invitation.id not in done]
+        finally:
+            try:
+                connection.close()
+            except Exception:
+                logger.exception('Failed to close the email connection')
+        self._record(outcomes, base_urls)
+
+    def _record(self, outcomes, base_urls):
+        now = timezone.now()
+        retries = {}
+        for invitation, exc in outcomes:
+            invitation.email_attempts += 1
+            if exc is None:
+                invitation.email_status = 'SENT'
+                invitation.email_sent_at = now
+                invitation.email_error = ''
+                self.sent += 1
+                metrics.INVITATION_EMAILS.inc('sent')
+            elif invitation.email_attempts >= self.max_attempts:
+                invitation.email_status = 'FAILED'
+                invitation.email_error = repr(exc)
+                self.failed += 1
+                metrics.INVITATION_EMAILS.inc('failed')
+                logger.warning('Giving up on invitation %s to %s: %r',
+                               invitation.id, invitation.email, exc)
+            else:
+                invitation.email_status = 'RETRYING'
+                invitation.email_error = repr(exc)
+                self.retried += 1
+                metrics.INVITATION_EMAILS.inc('retried')
+                delay = retry_delay(invitation.email_attempts, self.retry_delay)
+                retries.setdefault(delay, []).append((None, None, invitation.id, base_urls[invitation.id]))
+        RoomInvitation.objects.bulk_update(
+            [invitation for invitation, _ in outcomes],
+            ['email_status', 'email_attempts', 'email_sent_at', 'email_error'],
+        )
+        for delay, batch in retries.items():
+            self._reschedule(batch, delay)
+
+    def stats(self):
+        with self._cond:
+            depth = len(self._pending)
+        return {
+            'depth': depth,
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+
+invitation_mailer = InvitationMailer()
+
+
+@metrics.register_collector
+def collect_mail_queue():
+    return [
+        ('clust_invitation_queue_depth', 'gauge', 'Invitation emails waiting to be sent or retried.',
+         [('', {}, invitation_mailer.stats()['depth'])]),
+    ]
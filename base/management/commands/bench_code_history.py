@@ -0,0 +1,199 @@
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from base.models import Room, User
+from base.utils import code_cache, reconstruct_code, stored_size
+
+SIZES = {'small': 2 * 1024, '100k': 100 * 1024, '1m': 1024 * 1024}
+WORDS = ['self', 'value', 'result', 'items', 'index', 'count', 'data', 'node', 'name', 'total']
+
+
+def synthetic_file(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.1:
+            line = f'def {rng.choice(WORDS)}_{len(lines)}({rng.choice(WORDS)}):'
+        else:
+            indent = '    ' * rng.randint(1, 3)
+            line = f'{indent}{rng.choice(WORDS)} = {rng.choice(WORDS)}.{rng.choice(WORDS)}({rng.randint(0, 99)})'
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+
+class Editor:
+    # Edits cluster around a cursor that mostly moves a little between
+    # edits, like someone typing: many small inserts and deletes, the odd
+    # line rewrite and the rare pasted block
+    def __init__(self, rng, text):
+        self.rng = rng
+        self.text = text
+        self.cursor = rng.randrange(len(text))
+
+    def edit(self):
+        rng = self.rng
+        if rng.random() < 0.05:
+            self.cursor = rng.randrange(len(self.text))
+        else:
+            self.cursor = max(0, min(len(self.text), self.cursor + int(rng.gauss(0, 200))))
+        at = self.cursor
+        kind = rng.random()
+        if kind < 0.70:
+            insert = ''.join(rng.choice('abcdefghij _.()') for _ in range(rng.randint(1, 20)))
+            self.text = self.text[:at] + insert + self.text[at:]
+        elif kind < 0.90:
+            self.text = self.text[:at] + self.text[at + rng.randint(1, 50):]
+        elif kind < 0.98:
+            start = self.text.rfind('\n', 0, at) + 1
+            end = self.text.find('\n', at)
+            end = len(self.text) if end == -1 else end
+            self.text = self.text[:start] + f'    {rng.choice(WORDS)} = None' + self.text[end:]
+        else:
+            block = synthetic_file(rng, rng.randint(500, 5000))
+            self.text = self.text[:at] + block + self.text[at:]
+        return self.text
+
+    def save(self):
+        for _ in range(self.rng.randint(1, 10)):
+            self.edit()
+        return self.text
+
+
+def summary_ms(samples):
+    samples = sorted(samples)
+    return {
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def clear_caches():
+    code_cache.clear()
+    cache.clear()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark save_code, latest-code and historical reconstruct_code on "
+        "synthetic edit histories for small, 100 KB and 1 MB files. Runs on a "
+        "throwaway test database and reports timings, query counts and peak "
+        "allocations."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='small,100k,1m',
+                            help=f"Comma separated file sizes, from {', '.join(SIZES)}.")
+        parser.add_argument('--versions', type=int, default=100,
+                            help='Saved versions per history.')
+        parser.add_argument('--samples', type=int, default=20,
+                            help='Timed latest-code fetches and reconstructions per history.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON.')
+
+    def handle(self, *args, **options):
+        names = options['sizes'].split(',')
+        unknown = [name for name in names if name not in SIZES]
+        if unknown:
+            raise CommandError(f"Unknown size {unknown[0]!r}, choose from {', '.join(SIZES)}")
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = User.objects.create_user('bench@example.com', 'bench', 'password')
+            results = [
+                self.bench(name, user, options['versions'], options['samples'], random.Random(options['seed']))
+                for name in names
+            ]
+        finally:
+            clear_caches()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            f"{'size':>6} {'operation':>12} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} "
+            f"{'queries':>8} {'peak KiB':>9}"
+        )
+        for result in results:
+            for operation in ('save', 'latest_cold', 'latest_warm', 'history_cold'):
+                row = result[operation]
+                self.stdout.write(
+                    f"{result['size']:>6} {operation:>12} {row['mean_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+                    f"{row['max_ms']:>9.2f} {row['queries']:>8.1f} {row['peak_kib']:>9.1f}"
+                )
+            self.stdout.write(
+                f"{result['size']:>6} {'storage':>12} {result['snapshots']} snapshots, "
+                f"{result['stored_bytes'] / 1024:.1f} KiB stored for {result['versions']} versions"
+            )
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump({'benchmark': 'code_history', 'versions': options['versions'],
+                           'samples': options['samples'], 'seed': options['seed'],
+                           'results': results}, output, indent=2)
+
+    def bench(self, name, user, versions, samples, rng):
+        room = Room.objects.create(host=user, name=f'bench {name}')
+        client = Client()
+        save_url = reverse('save_code', args=[room.id])
+        latest_url = reverse('get_latest_code', args=[room.id])
+        editor = Editor(rng, synthetic_file(rng, SIZES[name]))
+
+        def save():
+            # Editing and encoding happen here, outside the timed call
+            body = json.dumps({'code': editor.save()})
+            return lambda: client.post(save_url, body, content_type='application/json')
+
+        def latest():
+            return lambda: client.get(latest_url)
+
+        def history():
+            version = rng.randint(1, versions)
+            return lambda: reconstruct_code(room, version)
+
+        result = {'size': name, 'bytes': len(editor.text)}
+        result['save'] = self.measure(versions, save)
+        result['latest_cold'] = self.measure(samples, latest, clear_caches)
+        result['latest_warm'] = self.measure(samples, latest)
+        result['history_cold'] = self.measure(samples, history, clear_caches)
+
+        totals = room.snippets.aggregate(stored=Sum(stored_size()), versions=Count('id'))
+        result['versions'] = totals['versions']
+        result['stored_bytes'] = totals['stored'] or 0
+        result['snapshots'] = room.snippets.filter(is_full=True).count()
+        return result
+
+    def measure(self, count, prepare, before=None):
+        # `prepare` returns the call to time. Timed first, then one extra call
+        # under tracemalloc so tracing does not skew the timings.
+        timings = []
+        queries = 0
+        for _ in range(count):
+            call = prepare()
+            if before:
+                before()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                call()
+                timings.append(time.perf_counter() - started)
+            queries += len(captured)
+
+        call = prepare()
+        if before:
+            before()
+        tracemalloc.start()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {**summary_ms(timings), 'queries': queries / count, 'peak_kib': peak / 1024}
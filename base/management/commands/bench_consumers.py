@@ -0,0 +1,227 @@
+import asyncio
+import json
+import random
+import time
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from base.models import CodeSnippets, Message, Room, User
+from base.routing import websocket_urlpatterns
+from base.writebehind import message_writer
+
+MARKER = 'bench:'
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(latencies, sent, elapsed):
+    latencies.sort()
+    return {
+        'sent': sent,
+        'delivered': len(latencies),
+        'sent_per_sec': sent / elapsed,
+        'delivered_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+class Client:
+    # One simulated browser: a ChatConsumer socket and a RoomConsumer socket
+    # for the same room, like the room and room-code pages
+    def __init__(self, app, room_id, user, index):
+        self.chat = WebsocketCommunicator(app, f'/ws/room/{room_id}/')
+        self.code = WebsocketCommunicator(app, f'/ws/room-code/{room_id}/')
+        self.chat.scope['user'] = self.code.scope['user'] = user
+        self.client_id = f'bench-{room_id}-{index}'
+        self.seq = 0
+
+    async def connect(self):
+        for communicator in (self.chat, self.code):
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError('A benchmark socket was refused')
+
+    async def disconnect(self):
+        for communicator in (self.chat, self.code):
+            await communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test ChatConsumer and RoomConsumer through WebsocketCommunicator "
+        "on a throwaway test database: N rooms x M clients sending chat "
+        "messages and code changes at fixed rates. Reports fan-out latency "
+        "percentiles, throughput and database writes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--clients', type=int, default=10, help='Clients per room.')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load.')
+        parser.add_argument('--chat-rate', type=float, default=0.5,
+                            help='Chat messages per second per client.')
+        parser.add_argument('--code-rate', type=float, default=2.0,
+                            help='Code changes per second per client.')
+        parser.add_argument('--redis', metavar='URL',
+                            help='Use channels_redis against this server (any Redis-compatible '
+                                 'server works) instead of the in-memory layer.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON.')
+
+    def handle(self, *args, **options):
+        if options['redis']:
+            try:
+                from channels_redis.core import RedisChannelLayer
+            except ImportError:
+                raise CommandError('--redis needs the channels_redis package')
+            layer = RedisChannelLayer(hosts=[options['redis']])
+        else:
+            layer = InMemoryChannelLayer(capacity=10000, group_expiry=3600)
+
+        random.seed(options['seed'])
+        old_layer = channel_layers.set('default', layer)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = asyncio.run(self.run(options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            channel_layers.set('default', old_layer)
+
+        results['layer'] = 'redis' if options['redis'] else 'memory'
+        self.stdout.write(
+            f"{options['rooms']} rooms x {options['clients']} clients, "
+            f"{results['elapsed']:.1f}s on the {results['layer']} layer"
+        )
+        self.stdout.write(f"{'traffic':>8} {'sent/s':>9} {'recv/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for name in ('chat', 'code'):
+            row = results[name]
+            self.stdout.write(
+                f"{name:>8} {row['sent_per_sec']:>9.1f} {row['delivered_per_sec']:>9.1f} "
+                + ' '.join(f"{row[key]:>8.2f}" if row[key] is not None else f"{'-':>8}"
+                           for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+            )
+        writes = results['db_writes']
+        self.stdout.write(
+            f"DB writes: {writes['messages']} messages in {writes['message_flushes']} flushes, "
+            f"{writes['code_versions']} code versions"
+        )
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump({'benchmark': 'consumers', 'options': {
+                    key: options[key] for key in
+                    ('rooms', 'clients', 'duration', 'chat_rate', 'code_rate', 'seed')
+                }, 'results': results}, output, indent=2)
+
+    async def run(self, options):
+        app = URLRouter(websocket_urlpatterns)
+        rooms, users = await asyncio.to_thread(self.create_fixtures, options['rooms'], options['clients'])
+
+        clients = [
+            Client(app, room.id, users[index], index)
+            for room in rooms for index in range(options['clients'])
+        ]
+        for client in clients:
+            await client.connect()
+
+        latencies = {'chat': [], 'code': []}
+        sent = {'chat': 0, 'code': 0}
+        flushes_before = message_writer.flushes
+        readers = [asyncio.ensure_future(self.read_chat(client, latencies['chat'])) for client in clients]
+        readers += [asyncio.ensure_future(self.read_code(client, latencies['code'])) for client in clients]
+
+        started = time.perf_counter()
+        deadline = started + options['duration']
+        await asyncio.gather(*(
+            self.drive(client, deadline, options['chat_rate'], options['code_rate'], sent)
+            for client in clients
+        ))
+        elapsed = time.perf_counter() - started
+        # Let the last frames land before stopping the readers
+        await asyncio.sleep(1)
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+        await message_writer.flush()
+        for client in clients:
+            await client.disconnect()
+        messages, versions = await asyncio.to_thread(self.count_writes)
+
+        return {
+            'elapsed': elapsed,
+            'sockets': len(clients) * 2,
+            'chat': summarize(latencies['chat'], sent['chat'], elapsed),
+            'code': summarize(latencies['code'], sent['code'], elapsed),
+            'db_writes': {
+                'messages': messages,
+                'message_flushes': message_writer.flushes - flushes_before,
+                'code_versions': versions,
+            },
+        }
+
+    def create_fixtures(self, room_count, client_count):
+        users = [
+            User.objects.create_user(f'bench{i}@example.com', f'bench{i}', 'password')
+            for i in range(client_count)
+        ]
+        rooms = [Room.objects.create(host=users[0], name=f'bench room {i}') for i in range(room_count)]
+        return rooms, users
+
+    def count_writes(self):
+        return Message.objects.count(), CodeSnippets.objects.count()
+
+    async def drive(self, client, deadline, chat_rate, code_rate, sent):
+        # Poisson arrivals for both kinds of traffic from one client
+        next_chat = time.perf_counter() + random.expovariate(chat_rate) if chat_rate else None
+        next_code = time.perf_counter() + random.expovariate(code_rate) if code_rate else None
+        while True:
+            due = min(t for t in (next_chat, next_code, deadline) if t is not None)
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            if due >= deadline:
+                return
+            stamp = f'{MARKER}{time.perf_counter()!r}'
+            if due == next_chat:
+                await client.chat.send_json_to({'message': stamp})
+                sent['chat'] += 1
+                next_chat += random.expovariate(chat_rate)
+            else:
+                await client.code.send_json_to({
+                    'type': 'code_change',
+                    'seq': client.seq,
+                    'code': {
+                        'from': {'line': 0, 'ch': 0}, 'to': {'line': 0, 'ch': 0},
+                        'text': [stamp, ''], 'origin': '+input', 'clientId': client.client_id,
+                    },
+                })
+                sent['code'] += 1
+                next_code += random.expovariate(code_rate)
+
+    async def read_chat(self, client, latencies):
+        while True:
+            data = json.loads((await client.chat.receive_output(timeout=3600)).get('text') or '{}')
+            message = data.get('message')
+            if isinstance(message, str) and message.startswith(MARKER):
+                latencies.append((time.perf_counter() - float(message[len(MARKER):])) * 1000)
+
+    async def read_code(self, client, latencies):
+        while True:
+            data = json.loads((await client.code.receive_output(timeout=3600)).get('text') or '{}')
+            if data.get('type') == 'code_sync':
+                client.seq = data['seq']
+            elif data.get('type') == 'code_batch':
+                now = time.perf_counter()
+                for op in data['ops']:
+                    client.seq = max(client.seq, op['seq'])
+                    if op['text'][0].startswith(MARKER):
+                        latencies.append((now - float(op['text'][0][len(MARKER):])) * 1000)
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from base.broadcast import encode_frame
+
+
+def code_batch(ops):
+    return {
+        'type': 'code_batch',
+        'ops': [
+            {
+                'from': {'line': i, 'ch': 4}, 'to': {'line': i, 'ch': 4},
+                'text': ['x'], 'origin': '+input', 'clientId': 'c0ffee-%d' % i,
+                'seq': i + 1, 'username': 'user%d' % i,
+            }
+            for i in range(ops)
+        ],
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure CPU time per group broadcast against group size, comparing "
+        "a json.dumps per recipient with a frame serialized once by the sender."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,50,200',
+                            help='Comma separated group sizes.')
+        parser.add_argument('--broadcasts', type=int, default=200,
+                            help='Broadcasts per group size and mode.')
+        parser.add_argument('--ops', type=int, default=10,
+                            help='Code ops per broadcast frame.')
+        parser.add_argument('--json', dest='json_path',
+                            help='Also write the results to this file as JSON.')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        payload = code_batch(options['ops'])
+        results = asyncio.run(self.run(sizes, options['broadcasts'], payload))
+
+        self.stdout.write(f"{'group':>6} {'per recipient us':>18} {'serialize once us':>18} {'speedup':>8}")
+        for row in results:
+            self.stdout.write(
+                f"{row['group_size']:>6} {row['per_recipient_us']:>18.1f} "
+                f"{row['serialize_once_us']:>18.1f} {row['speedup']:>7.2f}x"
+            )
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump({'benchmark': 'fanout', 'ops_per_frame': options['ops'],
+                           'broadcasts': options['broadcasts'], 'results': results}, output, indent=2)
+
+    async def run(self, sizes, broadcasts, payload):
+        results = []
+        for size in sizes:
+            per_recipient = await self.measure(size, broadcasts, payload, serialize_once=False)
+            once = await self.measure(size, broadcasts, payload, serialize_once=True)
+            results.append({
+                'group_size': size,
+                'per_recipient_us': per_recipient,
+                'serialize_once_us': once,
+                'speedup': per_recipient / once if once else 0,
+            })
+        return results
+
+    async def measure(self, size, broadcasts, payload, serialize_once):
+        # CPU microseconds for one group_send plus every recipient producing
+        # its outgoing websocket text
+        layer = InMemoryChannelLayer(capacity=broadcasts + 1, group_expiry=3600)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+
+        started = time.process_time()
+        for _ in range(broadcasts):
+            if serialize_once:
+                await layer.group_send('bench', encode_frame(payload))
+            else:
+                await layer.group_send('bench', {'type': 'code_batch', 'ops': payload['ops']})
+            for channel in channels:
+                event = await layer.receive(channel)
+                if serialize_once:
+                    text = event['text']
+                else:
+                    text = json.dumps({'type': 'code_batch', 'ops': event['ops']})
+        elapsed = time.process_time() - started
+        await layer.flush()
+        return elapsed / broadcasts * 1e6
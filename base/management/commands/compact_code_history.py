@@ -0,0 +1,119 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from base.models import Room, CodeSnippets
+from base.utils import apply_diff, code_cache, forget_chain_stats
+
+# Versions read and written per round trip while compacting a room
+CHUNK_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Collapse CodeSnippets history older than the retention window into "
+        "sparse full snapshots. Dropped versions no longer exist: history "
+        "endpoints answer 404 for them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=100,
+                            help='Number of most recent versions kept untouched per room.')
+        parser.add_argument('--stride', type=int, default=50,
+                            help='Keep one snapshot every N versions in the compacted range.')
+        parser.add_argument('--room', type=int, action='append', dest='rooms',
+                            help='Only compact this room (can be repeated).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without writing.')
+
+    def handle(self, *args, **options):
+        keep = max(options['keep'], 1)
+        stride = max(options['stride'], 1)
+        rooms = Room.objects.annotate(latest_version=Max('snippets__version_number'))
+        if options['rooms']:
+            rooms = rooms.filter(id__in=options['rooms'])
+
+        total_deleted = total_rewritten = 0
+        for room in rooms.filter(latest_version__gt=keep).iterator():
+            deleted, rewritten = self.compact_room(
+                room, room.latest_version - keep + 1, stride, options['dry_run'])
+            total_deleted += deleted
+            total_rewritten += rewritten
+            if deleted or rewritten:
+                self.stdout.write(
+                    f'Room {room.id}: {deleted} deleted, {rewritten} rewritten as snapshots')
+
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {total_deleted} versions, {total_rewritten} snapshots written'))
+
+    def compact_room(self, room, cutoff, stride, dry_run):
+        # One transaction per room, but versions are read CHUNK_SIZE at a
+        # time so a long history never has to fit in memory at once
+        with transaction.atomic():
+            deleted, rewritten, first_changed = self.compact_versions(room, cutoff, stride, dry_run)
+        if first_changed is not None:
+            # Chain stats from the first change on count from snapshots
+            # that moved, or belong to versions that are gone
+            forget_chain_stats(room.id, range(first_changed, room.latest_version + 1))
+        return deleted, rewritten
+
+    def compact_versions(self, room, cutoff, stride, dry_run):
+        deleted = rewritten = 0
+        first_changed = None
+        code = None
+        index = 0
+        last_version = -1
+        while True:
+            chunk = list(
+                room.snippets
+                .filter(version_number__gt=last_version, version_number__lte=cutoff)
+                .order_by('version_number')[:CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+            last_version = chunk[-1].version_number
+
+            to_delete = []
+            to_rewrite = []
+            snapshots = []
+            for snippet in chunk:
+                if code is None:
+                    # Rows before the first snapshot cannot be replayed
+                    if not snippet.is_full:
+                        continue
+                    code = ''
+                code = snippet.text if snippet.is_full else apply_diff(code, snippet.text)
+                if snippet.version_number >= cutoff:
+                    # First version inside the window must not depend on dropped rows
+                    keep = True
+                else:
+                    keep = index % stride == 0
+                index += 1
+                if not keep:
+                    to_delete.append(snippet)
+                elif not snippet.is_full:
+                    snippet.is_full = True
+                    snippet.text = code
+                    to_rewrite.append(snippet)
+                    snapshots.append((snippet.version_number, code))
+
+            deleted += len(to_delete)
+            rewritten += len(to_rewrite)
+            changed = [snippet.version_number for snippet in to_delete + to_rewrite]
+            if changed and first_changed is None:
+                first_changed = min(changed)
+            if dry_run or not changed:
+                continue
+            CodeSnippets.objects.bulk_update(
+                to_rewrite, ['is_full', 'codec', 'code_diff', 'code_blob'], batch_size=CHUNK_SIZE)
+            CodeSnippets.objects.filter(id__in=[snippet.id for snippet in to_delete]).delete()
+            # A version's text is the same before and after compaction, so
+            # these entries stay right even if the transaction rolls back
+            for version_number, snapshot in snapshots:
+                code_cache.set(room.id, version_number, snapshot)
+            code_cache.forget(room.id, [snippet.version_number for snippet in to_delete])
+
+        if dry_run:
+            first_changed = None
+        return deleted, rewritten, first_changed
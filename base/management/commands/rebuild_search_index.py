@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from base import search
+from base.models import Room, Message, Topic
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the SQLite FTS5 search index from rooms, messages and topics. "
+        "Without the FTS5 table there is nothing to rebuild: DEBUG sites use an "
+        "in-process index meant for development and tests only, which rebuilds "
+        "itself on first use, and other sites search the database directly."
+    )
+
+    def handle(self, *args, **options):
+        if not search.fts5_available():
+            raise CommandError(
+                "No FTS5 index table; searches use the development-only "
+                "in-process index or the database directly.")
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {search.FTS_TABLE}')
+            for room in Room.objects.select_related('topic').iterator():
+                search.index_room(room)
+            for message in Message.objects.only('id', 'body').iterator():
+                search.index_message(message)
+            for topic in Topic.objects.iterator():
+                search.index_topic(topic)
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from base import codec as code_codec
+from base.models import CodeSnippets
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrite stored CodeSnippets rows with another codec, in batches. "
+        "Text is unchanged, so cached versions stay valid."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--codec', choices=['plain', code_codec.ZLIB, code_codec.ZSTD],
+                            default=code_codec.CODE_CODEC or 'plain',
+                            help='Codec to store rows with (default: CLUST_CODE_CODEC).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows read and written per transaction.')
+        parser.add_argument('--room', type=int, action='append', dest='rooms',
+                            help='Only recompress this room (can be repeated).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without writing.')
+
+    def handle(self, *args, **options):
+        target = '' if options['codec'] == 'plain' else options['codec']
+        if target == code_codec.ZSTD and code_codec.zstandard is None:
+            raise CommandError('zstd needs the zstandard package')
+        batch_size = max(options['batch_size'], 1)
+
+        snippets = CodeSnippets.objects.order_by('id')
+        if options['rooms']:
+            snippets = snippets.filter(room_id__in=options['rooms'])
+
+        # Walked by id so rows that stay as they are are not read again
+        last_id = 0
+        seen = rewritten = before = after = 0
+        while True:
+            batch = list(snippets.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            seen += len(batch)
+
+            changed = []
+            for snippet in batch:
+                if snippet.codec == target:
+                    continue
+                old_size = self.stored_size(snippet)
+                codec, code_diff, code_blob = code_codec.encode(snippet.text, target)
+                if codec == snippet.codec:
+                    # Too short to be worth compressing
+                    continue
+                snippet.codec, snippet.code_diff, snippet.code_blob = codec, code_diff, code_blob
+                before += old_size
+                after += self.stored_size(snippet)
+                changed.append(snippet)
+
+            if changed and not options['dry_run']:
+                with transaction.atomic():
+                    CodeSnippets.objects.bulk_update(changed, ['codec', 'code_diff', 'code_blob'])
+            rewritten += len(changed)
+
+        verb = 'Would rewrite' if options['dry_run'] else 'Rewrote'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {rewritten} of {seen} rows: {before} -> {after} stored bytes'))
+
+    def stored_size(self, snippet):
+        if snippet.code_blob is not None:
+            return len(snippet.code_blob)
+        return len(snippet.code_diff.encode())
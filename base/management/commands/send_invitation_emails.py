@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from base.mailqueue import InvitationMailer
+from base.models import RoomInvitation
+
+
+class Command(BaseCommand):
+    help = (
+        "Send invitation emails still QUEUED or RETRYING, e.g. after a restart "
+        "dropped the in-memory queue. Runs in the foreground, one SMTP "
+        "connection per batch; expired and used invitations are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='Site root for the invitation links, e.g. https://clust.example.com/')
+        parser.add_argument('--include-failed', action='store_true',
+                            help='Also retry invitations already marked FAILED.')
+
+    def handle(self, *args, **options):
+        statuses = ['QUEUED', 'RETRYING']
+        invitations = RoomInvitation.objects.filter(is_used=False, expires_at__gt=timezone.now())
+        if options['include_failed']:
+            statuses.append('FAILED')
+            # A fresh round of attempts for invitations that had given up
+            invitations.filter(email_status='FAILED').update(email_status='RETRYING', email_attempts=0)
+        invitation_ids = list(
+            invitations.filter(email_status__in=statuses).order_by('id').values_list('id', flat=True)
+        )
+
+        # Retries are due immediately: this is a one-off pass, not a worker
+        mailer = InvitationMailer(retry_delay=0, background=False)
+        mailer.enqueue(invitation_ids, options['base_url'])
+        mailer.flush()
+        stats = mailer.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {stats['sent']} of {len(invitation_ids)} invitations in {stats['batches']} batches, "
+            f"{stats['failed']} failed"))
@@ -0,0 +1,256 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
+
+# Prometheus text exposition without a client library. Every thread updates
+# its own shard of each metric, so the hot paths never take a lock; the
+# shards are only summed when /metrics is scraped.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+_collectors = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        _metrics.append(self)
+
+    def _shard(self):
+        shard = getattr(self._local, 'values', None)
+        if shard is None:
+            shard = self._local.values = {}
+            # Once per thread, never on the update path again
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _label_text(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def collect(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        return shards
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def totals(self):
+        totals = {}
+        for shard in self.collect():
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self):
+        for labels, value in sorted(self.totals().items()):
+            yield f'{self.name}{self._label_text(labels)} {value}'
+
+
+class Gauge(Counter):
+    # Up/down counts summed over threads, e.g. open connections
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        entry = shard.get(labels)
+        if entry is None:
+            # Per-bucket counts (not cumulative), then sum
+            entry = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        totals = {}
+        for shard in self.collect():
+            for labels, entry in list(shard.items()):
+                total = totals.setdefault(labels, [0] * len(entry))
+                for index, value in enumerate(entry):
+                    total[index] += value
+        for labels, entry in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket{self._label_text(labels, [("le", le)])} {cumulative}'
+            yield f'{self.name}_sum{self._label_text(labels)} {entry[-1]}'
+            yield f'{self.name}_count{self._label_text(labels)} {cumulative}'
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def register_collector(collect):
+    # collect() returns (name, kind, help, samples) tuples computed at scrape
+    # time from state other modules already keep; samples are
+    # (suffix, labels dict, value)
+    _collectors.append(collect)
+    return collect
+
+
+def histogram_samples(values, buckets):
+    samples = []
+    for bound in buckets:
+        samples.append(('_bucket', {'le': repr(bound)}, sum(1 for value in values if value <= bound)))
+    samples.append(('_bucket', {'le': '+Inf'}, len(values)))
+    samples.append(('_sum', {}, sum(values)))
+    samples.append(('_count', {}, len(values)))
+    return samples
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, documentation, samples in collect():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{escape(val)}"' for key, val in labels.items())
+                label_text = f'{{{label_text}}}' if label_text else ''
+                lines.append(f'{name}{suffix}{label_text} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+WEBSOCKET_CONNECTIONS = Gauge(
+    'clust_websocket_connections', 'Open websocket connections.', ['consumer'])
+WEBSOCKET_CONNECTS = Counter(
+    'clust_websocket_connects_total', 'Websocket connection attempts.', ['consumer', 'outcome'])
+WEBSOCKET_MESSAGES = Counter(
+    'clust_websocket_messages_total', 'Websocket messages received from clients.', ['consumer', 'type'])
+CHAT_MESSAGES = Counter(
+    'clust_chat_messages_total', 'Chat messages posted over websockets.', ['consumer'])
+CODE_OPS = Counter(
+    'clust_code_ops_total', 'Code operations applied to room documents.')
+GROUP_SEND_SECONDS = Histogram(
+    'clust_group_send_seconds', 'Time spent in channel_layer.group_send.', ['kind'])
+DB_WAIT_SECONDS = Histogram(
+    'clust_db_wait_seconds', 'Time database_sync_to_async calls wait for their thread.', ['call'])
+DB_RUN_SECONDS = Histogram(
+    'clust_db_run_seconds', 'Time database_sync_to_async calls run in their thread.', ['call'])
+VIEW_SECONDS = Histogram(
+    'clust_view_seconds', 'Time spent in instrumented views.', ['view'])
+VIEW_RESPONSES = Counter(
+    'clust_view_responses_total', 'Responses from instrumented views.', ['view', 'status'])
+INVITATION_EMAILS = Counter(
+    'clust_invitation_emails_total', 'Invitation email delivery attempts.', ['outcome'])
+
+
+def timed_database_sync_to_async(func):
+    # database_sync_to_async that also records how long each call waited
+    # for the database thread and how long it ran there
+    name = func.__name__
+
+    def run(queued, *args, **kwargs):
+        started = time.perf_counter()
+        DB_WAIT_SECONDS.observe(started - queued, name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_RUN_SECONDS.observe(time.perf_counter() - started, name)
+
+    call = database_sync_to_async(run)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await call(time.perf_counter(), *args, **kwargs)
+    return wrapper
+
+
+async def group_send(channel_layer, group, message, kind):
+    with GROUP_SEND_SECONDS.time(kind):
+        await channel_layer.group_send(group, message)
+
+
+def timed_view(name):
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                with _ViewTimer(name) as timer:
+                    timer.response = await view(request, *args, **kwargs)
+                    return timer.response
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                with _ViewTimer(name) as timer:
+                    timer.response = view(request, *args, **kwargs)
+                    return timer.response
+        return wrapper
+    return decorator
+
+
+class _ViewTimer:
+    def __init__(self, name):
+        self.name = name
+        self.response = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.response is not None:
+            status = self.response.status_code
+        elif exc_type is not None and issubclass(exc_type, Http404):
+            status = 404
+        elif exc_type is not None and issubclass(exc_type, PermissionDenied):
+            status = 403
+        else:
+            status = 500
+        VIEW_SECONDS.observe(time.perf_counter() - self.started, self.name)
+        VIEW_RESPONSES.inc(self.name, status)
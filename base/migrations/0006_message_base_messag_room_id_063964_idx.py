@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_codesnippets_base_codesn_room_id_00cea5_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created', 'id'], name='base_messag_room_id_063964_idx'),
+        ),
+    ]
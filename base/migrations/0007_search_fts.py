@@ -0,0 +1,41 @@
+from django.db import migrations, OperationalError
+
+
+FTS_TABLE = 'base_search_fts'
+
+
+def create_fts_index(apps, schema_editor):
+    # Only SQLite builds with FTS5 get the table; everything else falls back
+    # to base.search.PythonIndex
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        try:
+            # rowid is (document id << 2) | kind, see base.search
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(body)')
+        except OperationalError:
+            return
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, body) "
+            "SELECT (r.id << 2) | 1, r.name || ' ' || COALESCE(t.name, '') || ' ' || COALESCE(r.description, '') "
+            "FROM base_room r LEFT JOIN base_topic t ON t.id = r.topic_id"
+        )
+        cursor.execute(f"INSERT INTO {FTS_TABLE}(rowid, body) SELECT (id << 2) | 2, body FROM base_message")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}(rowid, body) SELECT (id << 2) | 3, name FROM base_topic")
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_message_base_messag_room_id_063964_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_index, drop_fts_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_search_fts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='codesnippets',
+            index=models.Index(condition=models.Q(('is_full', True)), fields=['room', 'version_number'], name='base_codesnippets_checkpoint'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_codesnippets_base_codesnippets_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='codesnippets',
+            name='code_blob',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='codesnippets',
+            name='codec',
+            field=models.CharField(blank=True, default='', max_length=8),
+        ),
+        migrations.AlterField(
+            model_name='codesnippets',
+            name='code_diff',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_codesnippets_code_blob_codesnippets_codec_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='codesnippets',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_codesnippets_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roominvitation',
+            name='email_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='roominvitation',
+            name='email_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='roominvitation',
+            name='email_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Invitations from before the queue were sent inline, so existing
+        # rows are SENT and only new ones start out QUEUED
+        migrations.AddField(
+            model_name='roominvitation',
+            name='email_status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('RETRYING', 'Retrying'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='SENT', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='roominvitation',
+            name='email_status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('RETRYING', 'Retrying'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='QUEUED', max_length=10),
+        ),
+    ]
@@ -1,12 +1,15 @@
 from django.db import models
 import uuid
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.urls import reverse
 from datetime import datetime, timedelta
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import BaseUserManager
+from .codec import encode as encode_code, decode as decode_code
+
+INVITATION_LIFETIME = timedelta(days=7)
 
 
 class CustomUserManager(BaseUserManager):
@@ -80,11 +83,21 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['-updated', '-created']
+        indexes = [
+            models.Index(fields=['room', 'created', 'id']),
+        ]
 
     def __str__(self):
         return self.body[0:50]
 
 class RoomInvitation(models.Model):
+    EMAIL_STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('RETRYING', 'Retrying'),
+        ('SENT', 'Sent'),
+        ('FAILED', 'Failed'),
+    ]
+
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     email = models.EmailField()
     token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
@@ -92,17 +105,22 @@ class RoomInvitation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
     is_used = models.BooleanField(default=False)
+    # Delivery through base/mailqueue.py
+    email_status = models.CharField(max_length=10, choices=EMAIL_STATUS_CHOICES, default='QUEUED')
+    email_attempts = models.PositiveSmallIntegerField(default=0)
+    email_sent_at = models.DateTimeField(null=True, blank=True)
+    email_error = models.TextField(blank=True)
 
     def save(self, *args, **kwargs):
         if not self.expires_at:
-            self.expires_at = datetime.now() + timedelta(days=7)
+            self.expires_at = datetime.now() + INVITATION_LIFETIME
         super().save(*args, **kwargs)
 
-    def send_invitation_email(self, request):
-        invitation_url = request.build_absolute_uri(
-            reverse('join_room', args=[str(self.token)])
-        )
-        
+    def invitation_email(self, base_url, connection=None):
+        # base_url is the site root, e.g. request.build_absolute_uri('/'),
+        # so the message can be built outside the request
+        invitation_url = base_url.rstrip('/') + reverse('join_room', args=[str(self.token)])
+
         context = {
             'room_name': self.room.name,
             'invitation_url': invitation_url,
@@ -117,14 +135,18 @@ class RoomInvitation(models.Model):
         This invitation expires on {self.expires_at.strftime('%Y-%m-%d %H:%M')}
         """
         
-        send_mail(
+        message = EmailMultiAlternatives(
             subject=f'Invitation to join {self.room.name}',
-            message=plain_message,
-            html_message=html_message,
+            body=plain_message,
             from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[self.email],
-            fail_silently=False,
+            to=[self.email],
+            connection=connection,
         )
+        message.attach_alternative(html_message, 'text/html')
+        return message
+
+    def send_invitation_email(self, request):
+        self.invitation_email(request.build_absolute_uri('/')).send(fail_silently=False)
 
 class RoomMembership(models.Model):
     ROLE_CHOICES = [
@@ -154,7 +176,13 @@ class CodeSnippets(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='snippets')
     version_number = models.IntegerField()
     is_full = models.BooleanField(default=False)
-    code_diff = models.TextField()
+    code_diff = models.TextField(blank=True)
+    # See base/codec.py: '' keeps the text in code_diff, otherwise it is
+    # compressed into code_blob
+    codec = models.CharField(max_length=8, blank=True, default='')
+    code_blob = models.BinaryField(null=True, blank=True)
+    # sha256 of the full text at this version, '' on rows saved before it existed
+    content_hash = models.CharField(max_length=64, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -162,4 +190,15 @@ class CodeSnippets(models.Model):
         ordering = ['version_number']
         indexes = [
                 models.Index(fields=['room', '-version_number']),
+                # Full snapshots only: finding the checkpoint below any version
+                models.Index(fields=['room', 'version_number'], condition=models.Q(is_full=True),
+                             name='base_codesnippets_checkpoint'),
             ]
+
+    @property
+    def text(self):
+        return decode_code(self.codec, self.code_diff, self.code_blob)
+
+    @text.setter
+    def text(self, value):
+        self.codec, self.code_diff, self.code_blob = encode_code(value)
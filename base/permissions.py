@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Room, RoomMembership
+
+PERMISSION_CACHE_TIMEOUT = getattr(settings, 'CLUST_PERMISSION_CACHE_TIMEOUT', 10 * 60)
+# Other processes only learn about a change through the shared cache, so
+# entries in the per-process layer are trusted for this many seconds
+PERMISSION_LOCAL_TTL = getattr(settings, 'CLUST_PERMISSION_LOCAL_TTL', 5)
+PERMISSION_LOCAL_SIZE = getattr(settings, 'CLUST_PERMISSION_LOCAL_SIZE', 4096)
+
+MEMBER_ROLES = ('ADMIN', 'MEMBER')
+
+# Cached as a plain tuple; role is '' when the user has no membership
+RoomAccess = namedtuple('RoomAccess', ['is_private', 'role'])
+
+_MISSING = object()
+
+
+class PermissionCache:
+    # Room privacy and membership roles, keyed by room and by (room, user).
+    # Both halves are cached separately so a privacy change only drops one
+    # entry. Lookups go to a short-lived in-process LRU, then Django's cache,
+    # then the database; signals in base/signals.py drop entries on change.
+    def __init__(self, maxsize=PERMISSION_LOCAL_SIZE, ttl=PERMISSION_LOCAL_TTL,
+                 timeout=PERMISSION_CACHE_TIMEOUT):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+        return _MISSING
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _get(self, key, load):
+        value = self._local(key)
+        if value is _MISSING:
+            value = cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = load()
+                cache.set(key, value, self.timeout)
+            self._remember(key, value)
+        return value
+
+    async def _aget(self, key, load):
+        value = self._local(key)
+        if value is _MISSING:
+            value = await cache.aget(key, _MISSING)
+            if value is _MISSING:
+                value = await load()
+                await cache.aset(key, value, self.timeout)
+            self._remember(key, value)
+        return value
+
+    def _forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        cache.delete(key)
+
+    def is_private(self, room_id):
+        # None when the room does not exist
+        return self._get(
+            f'clust:perm:room:{room_id}',
+            lambda: Room.objects.filter(id=room_id).values_list('is_private', flat=True).first()
+        )
+
+    def role(self, room_id, user_id):
+        return self._get(
+            f'clust:perm:member:{room_id}:{user_id}',
+            lambda: RoomMembership.objects.filter(room_id=room_id, user_id=user_id)
+            .values_list('role', flat=True).first() or ''
+        )
+
+    async def ais_private(self, room_id):
+        return await self._aget(
+            f'clust:perm:room:{room_id}',
+            lambda: Room.objects.filter(id=room_id).values_list('is_private', flat=True).afirst()
+        )
+
+    async def arole(self, room_id, user_id):
+        async def load():
+            return await RoomMembership.objects.filter(room_id=room_id, user_id=user_id) \
+                .values_list('role', flat=True).afirst() or ''
+        return await self._aget(f'clust:perm:member:{room_id}:{user_id}', load)
+
+    def forget_room(self, room_id):
+        self._forget(f'clust:perm:room:{room_id}')
+
+    def forget_membership(self, room_id, user_id):
+        self._forget(f'clust:perm:member:{room_id}:{user_id}')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+permission_cache = PermissionCache()
+
+
+def room_key(room_id):
+    # URL segments like '01' must share the key signals invalidate by id
+    try:
+        return int(room_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def room_access(user, room_id):
+    # None when the room does not exist. Anonymous users never have a role,
+    # so their checks only read the room entry.
+    room_id = room_key(room_id)
+    if room_id is None:
+        return None
+    is_private = permission_cache.is_private(room_id)
+    if is_private is None:
+        return None
+    role = ''
+    if user is not None and user.is_authenticated:
+        role = permission_cache.role(room_id, user.id)
+    return RoomAccess(is_private, role)
+
+
+async def aroom_access(user, room_id):
+    # room_access for async views; pass the user from request.auser()
+    room_id = room_key(room_id)
+    if room_id is None:
+        return None
+    is_private = await permission_cache.ais_private(room_id)
+    if is_private is None:
+        return None
+    role = ''
+    if user is not None and user.is_authenticated:
+        role = await permission_cache.arole(room_id, user.id)
+    return RoomAccess(is_private, role)
+
+
+def is_member(access):
+    return access is not None and access.role in MEMBER_ROLES
+
+
+def can_view(access):
+    return access is not None and (not access.is_private or access.role in MEMBER_ROLES)
+
+
+def is_admin(access):
+    return access is not None and access.role == 'ADMIN'
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+# A socket that has not sent a heartbeat for this many seconds is dropped
+PRESENCE_TTL = getattr(settings, 'CLUST_PRESENCE_TTL', 60)
+
+
+class RoomPresence:
+    # Who is online per room, in memory: room id -> channel name -> entry.
+    # A user counts as online while any of their sockets (chat or code page)
+    # is connected, so join/leave diffs are per user, not per socket.
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self._rooms = defaultdict(dict)
+        self._sweeper = None
+
+    def _users(self, room_id):
+        return {entry['id'] for entry in self._rooms.get(room_id, {}).values()}
+
+    def join(self, room_id, channel_name, user):
+        # Returns True when the user was not online in the room before
+        first = user.id not in self._users(room_id)
+        self._rooms[room_id][channel_name] = {
+            'id': user.id, 'username': user.username, 'seen': time.monotonic()
+        }
+        return first
+
+    def leave(self, room_id, channel_name):
+        # Returns the entry when that was the user's last socket in the room
+        room = self._rooms.get(room_id)
+        if not room:
+            return None
+        entry = room.pop(channel_name, None)
+        if not room:
+            del self._rooms[room_id]
+        if entry is None or entry['id'] in self._users(room_id):
+            return None
+        return entry
+
+    def touch(self, room_id, channel_name, user=None):
+        # A socket the sweeper dropped (a background tab whose timers were
+        # throttled past the TTL) is added back on its next heartbeat.
+        # Returns True when that brought the user back online.
+        entry = self._rooms.get(room_id, {}).get(channel_name)
+        if entry is not None:
+            entry['seen'] = time.monotonic()
+            return False
+        if user is None or not user.is_authenticated:
+            return False
+        return self.join(room_id, channel_name, user)
+
+    def online(self, room_id):
+        users = {}
+        for entry in self._rooms.get(room_id, {}).values():
+            users[entry['id']] = {'id': entry['id'], 'username': entry['username']}
+        return list(users.values())
+
+    def socket_counts(self):
+        return [len(sockets) for sockets in self._rooms.values()]
+
+    def expire(self):
+        # Drops sockets that missed their heartbeats, returns (room id, entry)
+        # for every user that went offline as a result
+        deadline = time.monotonic() - self.ttl
+        gone = []
+        for room_id in list(self._rooms):
+            for channel_name, entry in list(self._rooms[room_id].items()):
+                if entry['seen'] < deadline:
+                    left = self.leave(room_id, channel_name)
+                    if left is not None:
+                        gone.append((room_id, left))
+        return gone
+
+    def start_sweeper(self, on_expired):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep(on_expired))
+
+    async def _sweep(self, on_expired):
+        while self._rooms:
+            await asyncio.sleep(self.ttl / 2)
+            for room_id, entry in self.expire():
+                await on_expired(room_id, entry)
+
+
+presence = RoomPresence()
+
+
+def presence_groups(room_id):
+    # Both the chat page and the code page sockets of a room get presence
+    return [f'chat_{room_id}', f'room_{room_id}']
@@ -0,0 +1,234 @@
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.template import base as template_base
+
+# Opt in by adding 'base.profiling.QueryProfilingMiddleware' to MIDDLEWARE.
+# A sampled request records its query count, DB time, template render time
+# and repeated query shapes under the resolved view name.
+SAMPLE_RATE = getattr(settings, 'CLUST_PROFILING_SAMPLE_RATE', 0.05)
+# Requests kept per view for the rolling percentiles
+WINDOW = getattr(settings, 'CLUST_PROFILING_WINDOW', 500)
+# Sampled requests at or above this many queries are logged
+QUERY_THRESHOLD = getattr(settings, 'CLUST_PROFILING_QUERY_THRESHOLD', 20)
+
+logger = logging.getLogger(__name__)
+
+_request = contextvars.ContextVar('clust_profiled_request', default=None)
+
+_IN_LIST = re.compile(r'\((?:%s, )+%s\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def fingerprint(sql):
+    # Parameters are already placeholders; collapse IN lists and inline
+    # literals so one ORM call site always maps to one shape
+    return _LITERAL.sub('?', _IN_LIST.sub('(...)', sql))
+
+
+class RequestProfile:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        if _request.get() is not self:
+            # A connection shared with work outside this request
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            self.shapes[fingerprint(sql)] += 1
+
+    def repeated(self):
+        return {shape: count for shape, count in self.shapes.items() if count > 1}
+
+
+class ViewStats:
+    def __init__(self, window):
+        self.requests = 0
+        self.queries = deque(maxlen=window)
+        self.db_ms = deque(maxlen=window)
+        self.render_ms = deque(maxlen=window)
+        self.total_ms = deque(maxlen=window)
+        self.repeated = Counter()
+
+    def summary(self):
+        return {
+            'sampled': self.requests,
+            'queries': percentiles(self.queries),
+            'db_ms': percentiles(self.db_ms),
+            'render_ms': percentiles(self.render_ms),
+            'total_ms': percentiles(self.total_ms),
+            # Shape -> sampled requests that ran it more than once
+            'repeated_queries': dict(self.repeated.most_common(10)),
+        }
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+    pick = lambda fraction: values[min(len(values) - 1, int(len(values) * fraction))]
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1]}
+
+
+class ProfileStore:
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._views = defaultdict(lambda: ViewStats(self.window))
+        self._lock = threading.Lock()
+
+    def record(self, view_name, profile, total):
+        repeated = profile.repeated()
+        with self._lock:
+            stats = self._views[view_name]
+            stats.requests += 1
+            stats.queries.append(profile.queries)
+            stats.db_ms.append(profile.db_time * 1000)
+            stats.render_ms.append(profile.render_time * 1000)
+            stats.total_ms.append(total * 1000)
+            stats.repeated.update(repeated.keys())
+        if repeated or profile.queries >= QUERY_THRESHOLD:
+            logger.warning(
+                '%s ran %d queries (%.1f ms DB, %.1f ms render, %.1f ms total)%s',
+                view_name, profile.queries, profile.db_time * 1000, profile.render_time * 1000,
+                total * 1000,
+                ''.join(f'\n  {count}x {shape}' for shape, count in sorted(
+                    repeated.items(), key=lambda item: -item[1])),
+            )
+
+    def snapshot(self):
+        with self._lock:
+            return {name: stats.summary() for name, stats in sorted(self._views.items())}
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+
+profiles = ProfileStore()
+
+_original_render = template_base.Template.render
+# Template.render is swapped only while a sampled request is in flight
+_rendering = 0
+_rendering_lock = threading.Lock()
+
+
+def _profiled_render(self, context):
+    # Only the outermost template counts, includes render inside it
+    profile = _request.get()
+    if profile is None:
+        return _original_render(self, context)
+    profile.render_depth += 1
+    started = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        profile.render_depth -= 1
+        if profile.render_depth == 0:
+            profile.render_time += time.perf_counter() - started
+
+
+def _hook_render():
+    global _rendering
+    with _rendering_lock:
+        _rendering += 1
+        if _rendering == 1:
+            template_base.Template.render = _profiled_render
+
+
+def _unhook_render():
+    global _rendering
+    with _rendering_lock:
+        _rendering -= 1
+        if _rendering == 0:
+            template_base.Template.render = _original_render
+
+
+def _wrap_connections(profile):
+    # Connections belong to the thread, so this runs in the thread that
+    # does the request's queries
+    for alias in connections:
+        connections[alias].execute_wrappers.append(profile)
+
+
+def _unwrap_connections(profile):
+    for alias in connections:
+        wrappers = connections[alias].execute_wrappers
+        if profile in wrappers:
+            wrappers.remove(profile)
+
+
+class QueryProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, sample_rate=None):
+        self.get_response = get_response
+        self.sample_rate = SAMPLE_RATE if sample_rate is None else sample_rate
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _request.set(profile)
+        _hook_render()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _unhook_render()
+            _request.reset(token)
+        self.record(request, profile, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        profile = RequestProfile()
+        token = _request.set(profile)
+        _hook_render()
+        started = time.perf_counter()
+        try:
+            # Async ORM calls and adapted sync views share the request's
+            # thread-sensitive worker; wrap the connections there
+            await sync_to_async(_wrap_connections)(profile)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(_unwrap_connections)(profile)
+        finally:
+            _unhook_render()
+            _request.reset(token)
+        self.record(request, profile, time.perf_counter() - started)
+        return response
+
+    def record(self, request, profile, total):
+        match = getattr(request, 'resolver_match', None)
+        profiles.record(match.view_name if match else 'unresolved', profile, total)
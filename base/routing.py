@@ -10,4 +10,8 @@ websocket_urlpatterns = [
         r'ws/room-code/(?P<room_id>\d+)', 
         consumers.RoomConsumer.as_asgi()
     ),
+    re_path(
+        r'ws/activity/$',
+        consumers.ActivityConsumer.as_asgi()
+    ),
 ]
\ No newline at end of file
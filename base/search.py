@@ -0,0 +1,289 @@
+"""Ranked search over rooms, messages and topics.
+
+Production search runs on the SQLite FTS5 table from migration 0007, which
+every worker shares. Databases without it use plain database lookups.
+PythonIndex, the in-process inverted index, is for development and tests
+only: it loads every message into one process on first use and only sees
+the writes made by that process, so other workers would serve stale hits.
+"""
+import bisect
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, When, IntegerField, Q
+
+# 'auto' uses SQLite FTS5 when the index table exists, otherwise the
+# in-process index under DEBUG and database lookups elsewhere. 'python' and
+# 'database' force one of those.
+SEARCH_BACKEND = getattr(settings, 'CLUST_SEARCH_BACKEND', 'auto')
+# Ranked hits considered per query; results beyond this are not paginated to
+SEARCH_LIMIT = getattr(settings, 'CLUST_SEARCH_LIMIT', 500)
+
+FTS_TABLE = 'base_search_fts'
+TOKEN_RE = re.compile(r'\w+')
+
+# Every indexed document is a (kind, id) pair. The FTS5 rowid packs both so
+# updates and deletes are rowid lookups rather than scans.
+ROOM, MESSAGE, TOPIC = 1, 2, 3
+KIND_BITS = 2
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+
+def room_text(room):
+    topic = room.topic.name if room.topic_id else ''
+    return ' '.join(filter(None, [room.name, topic, room.description]))
+
+
+def message_text(message):
+    return message.body
+
+
+def topic_text(topic):
+    return topic.name
+
+
+class PythonIndex:
+    # In-process inverted index: kind -> token -> {doc id: term frequency}.
+    # Built from the database on first use and kept current by signals.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built = False
+        self._postings = defaultdict(lambda: defaultdict(dict))
+        self._vocabulary = defaultdict(list)
+        self._documents = defaultdict(dict)
+
+    def _build(self):
+        from .models import Room, Message, Topic
+        for room in Room.objects.select_related('topic').iterator():
+            self._add(ROOM, room.id, room_text(room))
+        for message_id, body in Message.objects.values_list('id', 'body').iterator():
+            self._add(MESSAGE, message_id, body)
+        for topic_id, name in Topic.objects.values_list('id', 'name').iterator():
+            self._add(TOPIC, topic_id, name)
+        self._built = True
+
+    def _ensure_built(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._build()
+
+    def _add(self, kind, doc_id, text):
+        self._remove(kind, doc_id)
+        tokens = tokenize(text)
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        postings = self._postings[kind]
+        vocabulary = self._vocabulary[kind]
+        for token, count in counts.items():
+            if token not in postings:
+                bisect.insort(vocabulary, token)
+            postings[token][doc_id] = count
+        self._documents[kind][doc_id] = (len(tokens), tuple(counts))
+
+    def _remove(self, kind, doc_id):
+        document = self._documents[kind].pop(doc_id, None)
+        if document is None:
+            return
+        postings = self._postings[kind]
+        for token in document[1]:
+            docs = postings.get(token)
+            if docs is None:
+                continue
+            docs.pop(doc_id, None)
+            if not docs:
+                del postings[token]
+                vocabulary = self._vocabulary[kind]
+                del vocabulary[bisect.bisect_left(vocabulary, token)]
+
+    def index(self, kind, doc_id, text):
+        # Before the first build the database is the source of truth anyway
+        if self._built:
+            with self._lock:
+                self._add(kind, doc_id, text)
+
+    def index_many(self, kind, documents):
+        if self._built:
+            with self._lock:
+                for doc_id, text in documents:
+                    self._add(kind, doc_id, text)
+
+    def remove(self, kind, doc_id):
+        if self._built:
+            with self._lock:
+                self._remove(kind, doc_id)
+
+    def search(self, kind, query, limit=SEARCH_LIMIT):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        self._ensure_built()
+        with self._lock:
+            postings = self._postings[kind]
+            vocabulary = self._vocabulary[kind]
+            documents = self._documents[kind]
+            total = len(documents) or 1
+            average = sum(length for length, _ in documents.values()) / total or 1
+            scores = None
+            for term in terms:
+                # Terms match as prefixes, like FTS5 "term"* queries
+                term_scores = defaultdict(float)
+                start = bisect.bisect_left(vocabulary, term)
+                for token in vocabulary[start:]:
+                    if not token.startswith(term):
+                        break
+                    docs = postings[token]
+                    idf = math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for doc_id, count in docs.items():
+                        norm = count + 1.2 * (0.25 + 0.75 * documents[doc_id][0] / average)
+                        term_scores[doc_id] += idf * count * 2.2 / norm
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {doc_id: score + term_scores[doc_id]
+                              for doc_id, score in scores.items() if doc_id in term_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [doc_id for doc_id, _ in ranked[:limit]]
+
+
+class Fts5Index:
+    # SQLite FTS5 table created by migration 0007, ranked with bm25()
+    def rowid(self, kind, doc_id):
+        return (doc_id << KIND_BITS) | kind
+
+    def index(self, kind, doc_id, text):
+        rowid = self.rowid(kind, doc_id)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [rowid])
+            cursor.execute(f'INSERT INTO {FTS_TABLE}(rowid, body) VALUES (%s, %s)', [rowid, text])
+
+    def index_many(self, kind, documents):
+        # One statement each for the deletes and inserts of a whole batch
+        rows = [(self.rowid(kind, doc_id), text) for doc_id, text in documents]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [[rowid] for rowid, _ in rows])
+            cursor.executemany(f'INSERT INTO {FTS_TABLE}(rowid, body) VALUES (%s, %s)', rows)
+
+    def remove(self, kind, doc_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [self.rowid(kind, doc_id)])
+
+    def search(self, kind, query, limit=SEARCH_LIMIT):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'AND (rowid & %s) = %s ORDER BY rank LIMIT %s',
+                [match, (1 << KIND_BITS) - 1, kind, limit]
+            )
+            return [rowid >> KIND_BITS for rowid, in cursor.fetchall()]
+
+
+class DatabaseIndex:
+    # Every term must appear in the document, newest first. There is no index
+    # to keep current, so it is right on every worker, at the cost of a scan.
+    fields = {
+        ROOM: ['name', 'topic__name', 'description'],
+        MESSAGE: ['body'],
+        TOPIC: ['name'],
+    }
+
+    def index(self, kind, doc_id, text):
+        pass
+
+    def index_many(self, kind, documents):
+        pass
+
+    def remove(self, kind, doc_id):
+        pass
+
+    def search(self, kind, query, limit=SEARCH_LIMIT):
+        from .models import Room, Message, Topic
+        terms = tokenize(query)
+        if not terms:
+            return []
+        model = {ROOM: Room, MESSAGE: Message, TOPIC: Topic}[kind]
+        queryset = model.objects.all()
+        for term in terms:
+            match = Q()
+            for field in self.fields[kind]:
+                match |= Q(**{f'{field}__icontains': term})
+            queryset = queryset.filter(match)
+        return list(queryset.order_by('-id').values_list('id', flat=True).distinct()[:limit])
+
+
+python_index = PythonIndex()
+database_index = DatabaseIndex()
+fts5_index = Fts5Index()
+_fts5_available = None
+
+
+def fts5_available():
+    global _fts5_available
+    if _fts5_available is None:
+        _fts5_available = False
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+                )
+                _fts5_available = cursor.fetchone() is not None
+    return _fts5_available
+
+
+def get_index():
+    if SEARCH_BACKEND == 'python':
+        return python_index
+    if SEARCH_BACKEND == 'database':
+        return database_index
+    if fts5_available():
+        return fts5_index
+    return python_index if settings.DEBUG else database_index
+
+
+def index_room(room):
+    get_index().index(ROOM, room.id, room_text(room))
+
+
+def index_message(message):
+    get_index().index(MESSAGE, message.id, message_text(message))
+
+
+def index_messages(messages):
+    get_index().index_many(MESSAGE, [(message.id, message_text(message)) for message in messages])
+
+
+def index_topic(topic):
+    get_index().index(TOPIC, topic.id, topic_text(topic))
+
+
+def remove_document(kind, doc_id):
+    get_index().remove(kind, doc_id)
+
+
+def search_ids(kind, query, limit=SEARCH_LIMIT):
+    return get_index().search(kind, query, limit)
+
+
+def ranked(queryset, ids):
+    # Filter a queryset to the hit ids, keeping the search ranking as ordering
+    if not ids:
+        return queryset.none()
+    rank = Case(*[When(pk=pk, then=position) for position, pk in enumerate(ids)],
+                output_field=IntegerField())
+    return queryset.filter(pk__in=ids).annotate(search_rank=rank).order_by('search_rank')
@@ -0,0 +1,86 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from . import activity, search
+from .models import Room, Message, Topic, RoomMembership
+from .permissions import permission_cache
+
+# Sent with the list of Message objects written by bulk_create, which
+# bypasses post_save
+messages_created = Signal()
+# Sent with the room id and the user ids given memberships by bulk_create
+memberships_created = Signal()
+
+
+def forget_room(room_id):
+    # Dropped again on commit so a check made mid-transaction cannot leave
+    # the old value cached
+    permission_cache.forget_room(room_id)
+    transaction.on_commit(lambda: permission_cache.forget_room(room_id))
+
+
+def forget_membership(room_id, user_id):
+    permission_cache.forget_membership(room_id, user_id)
+    transaction.on_commit(lambda: permission_cache.forget_membership(room_id, user_id))
+
+
+@receiver(post_save, sender=Room)
+def index_room(sender, instance, **kwargs):
+    search.index_room(instance)
+    forget_room(instance.id)
+
+
+@receiver(post_delete, sender=Room)
+def unindex_room(sender, instance, **kwargs):
+    search.remove_document(search.ROOM, instance.id)
+    forget_room(instance.id)
+
+
+@receiver([post_save, post_delete], sender=RoomMembership)
+def membership_changed(sender, instance, **kwargs):
+    forget_membership(instance.room_id, instance.user_id)
+    # Cached activity pages include private rooms the user belonged to
+    transaction.on_commit(activity.invalidate)
+
+
+@receiver(memberships_created)
+def memberships_added(sender, room_id, user_ids, **kwargs):
+    for user_id in user_ids:
+        forget_membership(room_id, user_id)
+    transaction.on_commit(activity.invalidate)
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, created, **kwargs):
+    search.index_message(instance)
+    transaction.on_commit(activity.invalidate)
+    if created:
+        transaction.on_commit(lambda: activity.publish([instance]))
+
+
+@receiver(messages_created)
+def index_messages(sender, messages, **kwargs):
+    search.index_messages(messages)
+    transaction.on_commit(activity.invalidate)
+    transaction.on_commit(lambda: activity.publish(messages))
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    search.remove_document(search.MESSAGE, instance.id)
+    transaction.on_commit(activity.invalidate)
+
+
+@receiver(post_save, sender=Topic)
+def index_topic(sender, instance, created, **kwargs):
+    search.index_topic(instance)
+    # Room documents include the topic name
+    if not created:
+        for room in instance.room_set.select_related('topic'):
+            search.index_room(room)
+
+
+@receiver(post_delete, sender=Topic)
+def unindex_topic(sender, instance, **kwargs):
+    search.remove_document(search.TOPIC, instance.id)
@@ -1,3 +1,602 @@
-from django.test import TestCase
+import json
+from collections import deque
+from io import StringIO
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.template import Template
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import search
+from .activity import first_page
+from .documents import RoomDocument, StaleOperation, get_document
+from .invitations import bulk_invite, classify
+from .mailqueue import InvitationMailer, invitation_mailer
+from .models import CodeSnippets, Message, Room, RoomInvitation, Topic, User, RoomMembership
+from .permissions import permission_cache, room_access, can_view, is_member
+from .presence import RoomPresence
+from .metrics import timed_database_sync_to_async
+from .profiling import RequestProfile, _original_render, fingerprint, profiles
+from .routing import websocket_urlpatterns
+from .utils import (
+    apply_diff, astore_code_version, code_cache, get_chain_stats, get_diff, reconstruct_code, store_code_version,
+)
+from .wire import InternTable, WireError, clean_client_id, encode_code_batch
+from .writebehind import MessageWriteBehind, message_writer, write_messages
+
+
+class HomeFeedTests(TestCase):
+    def setUp(self):
+        self.host = User.objects.create_user('host@example.com', 'host', 'password')
+        self.topic = Topic.objects.create(name='python')
+        self.members = [
+            User.objects.create_user(f'member{i}@example.com', f'member{i}', 'password')
+            for i in range(3)
+        ]
+
+    def create_rooms(self, count):
+        for i in range(count):
+            room = Room.objects.create(host=self.host, topic=self.topic, name=f'room {i}')
+            room.participants.add(*self.members)
+            for member in self.members:
+                RoomMembership.objects.create(user=member, room=room, role='MEMBER')
+
+    def count_home_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        self.client.force_login(self.members[0])
+        self.create_rooms(1)
+        few = self.count_home_queries()
+        self.create_rooms(10)
+        many = self.count_home_queries()
+        self.assertEqual(few, many)
+
+    def test_anonymous_query_count_does_not_grow_with_rooms(self):
+        self.create_rooms(1)
+        few = self.count_home_queries()
+        self.create_rooms(10)
+        many = self.count_home_queries()
+        self.assertEqual(few, many)
+
+    def test_rooms_are_listed_once_with_participant_count(self):
+        self.create_rooms(1)
+        self.client.force_login(self.members[0])
+        response = self.client.get(reverse('home'))
+        rooms = list(response.context['rooms'])
+        self.assertEqual(len(rooms), 1)
+        self.assertEqual(rooms[0].participant_count, 3)
+        self.assertEqual(response.context['room_count'], 1)
+
+    def test_private_rooms_only_for_members(self):
+        private = Room.objects.create(host=self.host, topic=self.topic, name='secret', is_private=True)
+        RoomMembership.objects.create(user=self.members[0], room=private, role='MEMBER')
+
+        self.client.force_login(self.members[0])
+        self.assertIn(private, self.client.get(reverse('home')).context['rooms'])
+        self.client.force_login(self.members[1])
+        self.assertNotIn(private, self.client.get(reverse('home')).context['rooms'])
+
+    def test_database_search_needs_no_index(self):
+        room = Room.objects.create(host=self.host, topic=self.topic, name='planning')
+        message = Message.objects.create(user=self.host, room=room, body='Quarterly launch plan')
+        with patch('base.search.SEARCH_BACKEND', 'database'):
+            response = self.client.get(reverse('home'), {'q': 'LAUNCH plan'})
+            self.assertEqual(search.search_ids(search.MESSAGE, 'launch'), [message.id])
+        self.assertIn(message, response.context['room_messages'])
+
+    def test_search_does_not_leak_private_messages(self):
+        private = Room.objects.create(host=self.host, topic=self.topic, name='secret', is_private=True)
+        RoomMembership.objects.create(user=self.members[0], room=private, role='MEMBER')
+        message = Message.objects.create(user=self.members[0], room=private, body='launch codes')
+
+        self.client.force_login(self.members[0])
+        response = self.client.get(reverse('home'), {'q': 'launch'})
+        self.assertIn(message, response.context['room_messages'])
+        for user in (self.members[1], None):
+            if user:
+                self.client.force_login(user)
+            else:
+                self.client.logout()
+            response = self.client.get(reverse('home'), {'q': 'launch'})
+            self.assertNotIn(message, response.context['room_messages'])
+
+
+class RoomAccessTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        permission_cache.clear()
+        self.host = User.objects.create_user('host@example.com', 'host', 'password')
+        self.member = User.objects.create_user('member@example.com', 'member', 'password')
+        self.room = Room.objects.create(host=self.host, name='secret', is_private=True)
+
+    def test_cached_checks_cost_no_queries(self):
+        RoomMembership.objects.create(user=self.member, room=self.room, role='MEMBER')
+        self.assertTrue(can_view(room_access(self.member, self.room.id)))
+        with self.assertNumQueries(0):
+            self.assertTrue(can_view(room_access(self.member, self.room.id)))
+
+    def test_shared_cache_survives_a_cold_process(self):
+        room_access(self.member, self.room.id)
+        permission_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertFalse(can_view(room_access(self.member, self.room.id)))
+
+    def test_membership_changes_invalidate(self):
+        url = reverse('room-messages', args=[self.room.id])
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        membership = RoomMembership.objects.create(user=self.member, room=self.room, role='MEMBER')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        membership.delete()
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_removed_members_drop_out_of_cached_activity(self):
+        membership = RoomMembership.objects.create(user=self.member, room=self.room, role='MEMBER')
+        message = Message.objects.create(user=self.host, room=self.room, body='plans')
+        self.assertIn(message, first_page(self.member)[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            membership.delete()
+        self.assertNotIn(message, first_page(self.member)[0])
+
+    def test_padded_room_ids_share_the_invalidated_key(self):
+        self.assertFalse(can_view(room_access(self.member, f'0{self.room.id}')))
+        RoomMembership.objects.create(user=self.member, room=self.room, role='MEMBER')
+        self.assertTrue(can_view(room_access(self.member, f'0{self.room.id}')))
+        self.assertIsNone(room_access(self.member, 'abc'))
+
+    def test_privacy_changes_invalidate(self):
+        url = reverse('room-messages', args=[self.room.id])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.room.is_private = False
+        self.room.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class CodeHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        code_cache.clear()
+        self.host = User.objects.create_user('host@example.com', 'host', 'password')
+        self.room = Room.objects.create(host=self.host, name='history')
+        for code in ['a\n', 'a\nb\n', 'a\nc\n']:
+            store_code_version(self.room, code)
+
+    def test_fetch_any_version(self):
+        url = reverse('code-version', args=[self.room.id, 2])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['code'], 'a\nb\n')
+        self.assertEqual(self.client.get(reverse('code-version', args=[self.room.id, 9])).status_code, 404)
+
+    def test_matching_etag_skips_history(self):
+        url = reverse('code-version', args=[self.room.id, 3])
+        etag = self.client.get(url)['ETag']
+        self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        # Only the row's hash is read, nothing is replayed
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_diff_and_list(self):
+        diff = self.client.get(reverse('code-diff', args=[self.room.id, 2, 3])).json()['diff']
+        self.assertIn('-b\n', diff)
+        self.assertIn('+c\n', diff)
+        versions = self.client.get(reverse('code-versions', args=[self.room.id])).json()['versions']
+        self.assertEqual([v['version'] for v in versions], [3, 2, 1])
+
+    def test_compacted_versions_are_gone(self):
+        for code in ['a\nd\n', 'a\ne\n']:
+            store_code_version(self.room, code)
+        get_chain_stats(self.room, 3)
+        call_command('compact_code_history', keep=1, stride=10, stdout=StringIO())
+        self.assertEqual(sorted(self.room.snippets.values_list('version_number', flat=True)), [1, 5])
+        with self.assertRaises(CodeSnippets.DoesNotExist):
+            reconstruct_code(self.room, 3)
+        self.assertIsNone(cache.get(f'clust:chain:{self.room.id}:3'))
+        self.assertEqual(self.client.get(reverse('code-version', args=[self.room.id, 3])).status_code, 404)
+        self.assertEqual(reconstruct_code(self.room, 5), 'a\ne\n')
+
+    def test_compaction_walks_history_in_chunks(self):
+        for i in range(12):
+            store_code_version(self.room, f'a\nline {i}\n')
+        texts = {version: reconstruct_code(self.room, version) for version in range(1, 16)}
+        code_cache.clear()
+        with patch('base.management.commands.compact_code_history.CHUNK_SIZE', 2):
+            call_command('compact_code_history', keep=2, stride=3, stdout=StringIO())
+        kept = list(self.room.snippets.order_by('version_number').values_list('version_number', flat=True))
+        self.assertEqual(kept, [1, 4, 7, 10, 13, 14, 15])
+        code_cache.clear()
+        for version in kept:
+            self.assertEqual(reconstruct_code(self.room, version), texts[version])
+
+    def test_chain_stats_count_uncompressed_patch_text(self):
+        old = reconstruct_code(self.room, 3)
+        new = old + 'value = compute(value)\n' * 100
+        store_code_version(self.room, new)
+        self.assertTrue(self.room.snippets.get(version_number=4).code_blob)
+        rolled = get_chain_stats(self.room, 4)
+        cache.clear()
+        self.assertEqual(get_chain_stats(self.room, 4), rolled)
+        self.assertGreaterEqual(rolled[0], len(get_diff(old, new)))
+
+@override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['base.profiling.QueryProfilingMiddleware'])
+class QueryProfilingTests(TestCase):
+    def setUp(self):
+        profiles.clear()
+        self.host = User.objects.create_user('host@example.com', 'host', 'password', is_staff=True)
+
+    def test_sampled_requests_are_recorded_per_view(self):
+        with patch('base.profiling.SAMPLE_RATE', 1.0):
+            self.client.get(reverse('topics'))
+            self.client.force_login(self.host)
+            report = self.client.get(reverse('debug-profiling')).json()
+        self.assertEqual(report['topics']['sampled'], 1)
+        self.assertGreater(report['topics']['queries']['max'], 0)
+        self.assertGreater(report['topics']['render_ms']['max'], 0)
+
+    def test_render_is_only_patched_during_sampled_requests(self):
+        with patch('base.profiling.SAMPLE_RATE', 1.0):
+            self.client.get(reverse('topics'))
+        self.assertIs(Template.render, _original_render)
+
+    async def test_async_requests_are_recorded(self):
+        with patch('base.profiling.SAMPLE_RATE', 1.0):
+            await self.async_client.get(reverse('topics'))
+        report = profiles.snapshot()
+        self.assertEqual(report['topics']['sampled'], 1)
+        self.assertGreater(report['topics']['queries']['max'], 0)
+
+    def test_repeated_query_shapes_are_reported(self):
+        profile = RequestProfile()
+        for room_id in (1, 2, 3):
+            profile.shapes[fingerprint(f'SELECT * FROM "base_room" WHERE "id" = {room_id}')] += 1
+        self.assertEqual(profile.repeated(), {'SELECT * FROM "base_room" WHERE "id" = ?': 3})
+
+
+class CodeSaveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        code_cache.clear()
+        self.host = User.objects.create_user('host@example.com', 'host', 'password')
+        self.room = Room.objects.create(host=self.host, name='editor')
+        self.save_url = reverse('save_code', args=[self.room.id])
+        self.latest_url = reverse('get_latest_code', args=[self.room.id])
+
+    def save(self, code, **headers):
+        return self.client.post(self.save_url, json.dumps({'code': code}),
+                                content_type='application/json', headers=headers)
+
+    def test_unchanged_code_is_not_written_again(self):
+        self.assertEqual(self.save('a = 1\n').json()['version'], 1)
+        self.assertEqual(self.save('a = 1\n').json()['version'], 1)
+        self.assertEqual(self.room.snippets.count(), 1)
+
+    def test_if_match_rejects_a_stale_base(self):
+        etag = self.save('a = 1\n')['ETag']
+        self.save('a = 2\n')
+        response = self.save('a = 3\n', If_Match=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response.json()['version'], 2)
+        self.assertEqual(self.save('a = 3\n', If_Match=response['ETag']).json()['version'], 3)
+
+    def test_weak_or_foreign_if_match_fails_the_precondition(self):
+        etag = self.save('a = 1\n')['ETag']
+        for tag in [f'W/{etag}', '"other-1"', f'"{self.room.id + 1}-1"']:
+            response = self.save('a = 2\n', If_Match=tag)
+            self.assertEqual((response.status_code, response['ETag']), (412, etag))
+        self.assertEqual(self.room.snippets.count(), 1)
+
+    def test_losing_a_version_race_retries(self):
+        store_code_version(self.room, 'a = 1\n')
+        store_code_version(self.room, 'a = 2\n')
+        snippets = CodeSnippets.objects.filter(room=self.room).order_by('-version_number') \
+            .values_list('version_number', 'content_hash')
+        # The first read misses version 2, as if it were written concurrently
+        with patch('base.utils.latest_snippet', side_effect=[snippets.filter(version_number=1), snippets]):
+            self.assertEqual(store_code_version(self.room, 'a = 3\n'), 3)
+        self.assertEqual(reconstruct_code(self.room, 3), 'a = 3\n')
+
+    def test_latest_code_revalidates_without_queries(self):
+        self.save('a = 1\n')
+        response = self.client.get(self.latest_url)
+        self.assertEqual(response.json(), {'code': 'a = 1\n', 'version': 1})
+        with self.assertNumQueries(0):
+            response = self.client.get(self.latest_url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes_since_a_version_apply_to_the_latest_code(self):
+        base = ''.join(f'line {i} = {i}\n' for i in range(50))
+        self.save(base)
+        self.save(base + 'extra = 1\n')
+        self.save(base.replace('line 3 ', 'renamed ') + 'extra = 1\n')
+        changes_url = reverse('code-changes', args=[self.room.id])
+        data = self.client.get(changes_url, {'since': 1}).json()
+        self.assertEqual(data['version'], 3)
+        code = base
+        for patch_text in data['patches']:
+            code = apply_diff(code, patch_text)
+        self.assertEqual(code, reconstruct_code(self.room, 3))
+        self.assertEqual(self.client.get(changes_url, {'since': 3}).json()['patches'], [])
+        # A rewrite is cheaper to send whole
+        self.save('b = 2\n')
+        self.assertEqual(self.client.get(changes_url, {'since': 1}).json()['code'], 'b = 2\n')
+
+
+class InvitationMailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        permission_cache.clear()
+        self.host = User.objects.create_user('host@example.com', 'host', 'password')
+        self.room = Room.objects.create(host=self.host, name='team')
+        RoomMembership.objects.create(user=self.host, room=self.room, role='ADMIN')
+        self.client.force_login(self.host)
+
+    def invite(self, email):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('invite-to-room', args=[self.room.id]), {'email': email})
+        self.assertEqual(response.status_code, 200)
+        return RoomInvitation.objects.get(email=email)
+
+    def test_outsiders_cannot_invite(self):
+        outsider = User.objects.create_user('outsider@example.com', 'outsider', 'password')
+        self.client.force_login(outsider)
+        url = reverse('invite-to-room', args=[self.room.id])
+        self.assertEqual(self.client.post(url, {'email': 'x@example.com'}).status_code, 403)
+        # No access at all, e.g. a permission entry cached before the room existed
+        with patch('base.views.permissions.room_access', return_value=None):
+            self.assertEqual(self.client.post(url, {'email': 'x@example.com'}).status_code, 403)
+        self.assertFalse(RoomInvitation.objects.exists())
+
+    def test_invitations_are_sent_off_request(self):
+        with patch.object(invitation_mailer, 'background', False):
+            invitation = self.invite('guest@example.com')
+            self.assertEqual(mail.outbox, [])
+            self.assertEqual(invitation.email_status, 'QUEUED')
+            invitation_mailer.flush()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(str(invitation.token), mail.outbox[0].body)
+        invitation.refresh_from_db()
+        self.assertEqual((invitation.email_status, invitation.email_attempts), ('SENT', 1))
+
+    def test_failed_sends_retry_then_give_up(self):
+        invitation = RoomInvitation.objects.create(room=self.room, email='guest@example.com', created_by=self.host)
+        mailer = InvitationMailer(max_attempts=2, retry_delay=0, background=False)
+        mailer.enqueue([invitation.id], 'http://testserver/')
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                   side_effect=[OSError('refused'), 1]):
+            mailer.flush()
+        invitation.refresh_from_db()
+        self.assertEqual((invitation.email_status, invitation.email_attempts), ('SENT', 2))
+
+        invitation = RoomInvitation.objects.create(room=self.room, email='other@example.com', created_by=self.host)
+        mailer.enqueue([invitation.id], 'http://testserver/')
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('refused')):
+            mailer.flush()
+        invitation.refresh_from_db()
+        self.assertEqual(invitation.email_status, 'FAILED')
+        self.assertIn('refused', invitation.email_error)
+
+    def test_bulk_invite_skips_members_and_pending_invites(self):
+        member = User.objects.create_user('member@example.com', 'member', 'password')
+        RoomMembership.objects.create(user=member, room=self.room, role='MEMBER')
+        existing = User.objects.create_user('existing@example.com', 'existing', 'password')
+        RoomInvitation.objects.create(room=self.room, email='pending@example.com', created_by=self.host)
+        upload = SimpleUploadedFile('team.csv', b'name,email\nA,new1@example.com\nB,new2@example.com\n')
+        with patch.object(invitation_mailer, 'background', False):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('bulk-invite-to-room', args=[self.room.id]), {
+                    'emails': 'member@example.com, pending@example.com\nexisting@example.com\nnot-an-email',
+                    'file': upload,
+                    'add_existing': '1',
+                })
+            invitation_mailer.flush()
+        data = response.json()
+        self.assertEqual(data['invited'], ['new1@example.com', 'new2@example.com'])
+        self.assertEqual(data['added'], ['existing@example.com'])
+        self.assertEqual(data['members'], ['member@example.com'])
+        self.assertEqual(data['pending'], ['pending@example.com'])
+        self.assertEqual(data['invalid'], ['not-an-email'])
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), data['invited'])
+        # bulk_create skips post_save, the cache must still see the new member
+        self.assertTrue(is_member(room_access(existing, self.room.id)))
+
+    def test_bulk_import_matches_addresses_ignoring_case(self):
+        alice = User.objects.create_user('alice@example.com', 'alice', 'password')
+        bob = User.objects.create_user('bob@example.com', 'bob', 'password')
+        self.assertFalse(is_member(room_access(alice, self.room.id)))
+        stale = classify(self.room, ['Alice@example.com', 'bob@example.com'])
+        # Bob joins between the lookup and the insert
+        RoomMembership.objects.create(user=bob, room=self.room, role='MEMBER')
+        with patch('base.invitations.classify', return_value=stale), \
+                self.captureOnCommitCallbacks(execute=True):
+            result = bulk_invite(self.room, self.host, ['Alice@example.com', 'bob@example.com'],
+                                 'http://testserver/', add_existing=True)
+        self.assertEqual((result['added'], result['members']), (['Alice@example.com'], ['bob@example.com']))
+        self.assertTrue(is_member(room_access(alice, self.room.id)))
+
+
+class WireTests(SimpleTestCase):
+    def op(self, seq, client_id):
+        return {'seq': seq, 'username': 'host', 'clientId': client_id, 'text': ['x'],
+                'from': {'line': 0, 'ch': 0}, 'to': {'line': 0, 'ch': 0}}
+
+    def test_client_ids_are_coerced_and_bounded(self):
+        self.assertEqual(clean_client_id(42), '42')
+        self.assertEqual(len(clean_client_id('x' * 100000)), 64)
+        self.assertIsNone(clean_client_id({'a': 1}))
+        encode_code_batch([self.op(1, 42)], InternTable())
+
+    def test_full_table_starts_over(self):
+        table = InternTable(limit=8)
+        for seq in range(20):
+            encode_code_batch([self.op(seq, f'client-{seq}')], table)
+            self.assertLessEqual(len(table.strings), 8)
+
+    def test_unencodable_batch_resets_the_table(self):
+        table = InternTable()
+        with self.assertRaises(WireError):
+            encode_code_batch([{**self.op(1, 'a'), 'seq': 2 ** 40}], table)
+        self.assertEqual(table.strings, [])
+
+
+class MessageWriteBehindTests(TestCase):
+    def test_messages_from_deleted_users_are_skipped(self):
+        host = User.objects.create_user('host@example.com', 'host', 'password')
+        gone = User.objects.create_user('gone@example.com', 'gone', 'password')
+        room = Room.objects.create(host=host, name='chat')
+        gone_id = gone.id
+        gone.delete()
+        created = write_messages([(host.id, room.id, 'hello'), (gone_id, room.id, 'bye')])
+        self.assertEqual([message.body for message in created], ['hello'])
+
+    def test_batch_is_searchable_and_indexed_in_one_pass(self):
+        host = User.objects.create_user('host@example.com', 'host', 'password')
+        room = Room.objects.create(host=host, name='chat')
+        rows = [(host.id, room.id, f'needle {n}') for n in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            created = write_messages(rows)
+        fts = [query for query in queries if search.FTS_TABLE in query['sql']]
+        if search.fts5_available():
+            self.assertLessEqual(len(fts), 2)
+        self.assertEqual(sorted(search.search_ids(search.MESSAGE, 'needle')),
+                         sorted(message.id for message in created))
+
+    def test_queue_is_exported_on_metrics(self):
+        with patch.object(message_writer, '_buffer', [(1, 1, 'a'), (1, 1, 'b')]), \
+                patch.object(message_writer, 'dropped', 3):
+            body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('clust_message_queue_depth 2\n', body)
+        self.assertIn('clust_message_queue_messages_total{outcome="dropped"} 3\n', body)
+
+    def test_batches_that_keep_failing_are_dropped(self):
+        attempts = []
+
+        def write_messages(batch):
+            attempts.append(list(batch))
+            raise IntegrityError('rejected')
+
+        writer = MessageWriteBehind()
+        writer._buffer = [(1, 1, 'a'), (1, 1, 'b')]
+        with patch('base.writebehind.awrite_messages', timed_database_sync_to_async(write_messages)), \
+                patch.object(writer, '_schedule'), self.assertLogs('base.writebehind', 'ERROR') as logs:
+            async_to_sync(writer.flush)()
+            self.assertEqual(len(writer._buffer), 2)
+            async_to_sync(writer.flush)()
+        self.assertEqual(attempts, [[(1, 1, 'a'), (1, 1, 'b')]] * 2)
+        self.assertEqual((writer._buffer, writer.dropped, writer.failures), ([], 2, 2))
+        self.assertIn('ERROR:base.writebehind:Dropped 2 chat messages that failed to write twice', logs.output)
+
+
+class PresenceTests(SimpleTestCase):
+    def test_heartbeat_after_expiry_brings_the_socket_back(self):
+        user = User(id=1, username='host')
+        room = RoomPresence(ttl=-1)
+        self.assertTrue(room.join(7, 'socket', user))
+        self.assertEqual([room_id for room_id, _ in room.expire()], [7])
+        self.assertEqual((room.online(7), room.socket_counts()), ([], []))
+        self.assertTrue(room.touch(7, 'socket', user))
+        self.assertEqual(room.online(7), [{'id': 1, 'username': 'host'}])
+        self.assertFalse(room.touch(7, 'socket', user))
+
+
+class RoomDocumentTests(SimpleTestCase):
+    def insert(self, line, ch, text):
+        return {'from': {'line': line, 'ch': ch}, 'to': {'line': line, 'ch': ch}, 'text': text}
+
+    def test_concurrent_insert_on_the_same_line(self):
+        document = RoomDocument(1, 'abcd')
+        document.apply(self.insert(0, 1, ['X']), 0)
+        op = document.apply(self.insert(0, 3, ['Q']), 0)
+        self.assertEqual(document.text, 'aXbcQd')
+        self.assertEqual(op['from'], {'line': 0, 'ch': 4})
+
+    def test_concurrent_insert_on_another_line(self):
+        document = RoomDocument(1, 'ab\ncd')
+        document.apply(self.insert(0, 2, ['XYZW']), 0)
+        document.apply(self.insert(1, 1, ['Q']), 0)
+        self.assertEqual(document.text, 'abXYZW\ncQd')
+
+    def test_concurrent_op_after_a_line_split(self):
+        document = RoomDocument(1, 'ab\ncd')
+        document.apply(self.insert(0, 1, ['', '']), 0)
+        op = document.apply(self.insert(1, 2, ['!']), 0)
+        self.assertEqual(document.text, 'a\nb\ncd!')
+        self.assertEqual(op['from'], {'line': 2, 'ch': 2})
+
+    def test_concurrent_delete_across_a_joined_line(self):
+        document = RoomDocument(1, 'ab\ncd\nef')
+        document.apply({'from': {'line': 0, 'ch': 2}, 'to': {'line': 1, 'ch': 0}, 'text': ['']}, 0)
+        document.apply({'from': {'line': 2, 'ch': 0}, 'to': {'line': 2, 'ch': 1}, 'text': ['']}, 0)
+        self.assertEqual(document.text, 'abcd\nf')
+
+    def test_ops_older_than_the_log_are_stale(self):
+        document = RoomDocument(1, 'ab')
+        with patch.object(document, 'log', deque(maxlen=1)):
+            document.apply(self.insert(0, 0, ['x']), 0)
+            document.apply(self.insert(0, 0, ['y']), 1)
+            with self.assertRaises(StaleOperation):
+                document.apply(self.insert(0, 0, ['z']), 0)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class RoomConsumerTests(TransactionTestCase):
+    async def connect(self, user, room_id):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/room-code/{room_id}/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        sync = await communicator.receive_json_from()
+        self.assertEqual(sync['type'], 'code_sync')
+        return communicator, sync
+
+    async def receive_ops(self, communicator, upto):
+        # Code ops in seq order until the document reaches `upto`
+        ops = []
+        while not ops or ops[-1]['seq'] < upto:
+            frame = await communicator.receive_json_from()
+            if frame['type'] == 'code_batch':
+                ops += frame['ops']
+        return ops
+
+    def replay(self, text, ops):
+        # What codeWebsocket.js does to its copy of the server document
+        document = RoomDocument(0, text)
+        for op in ops:
+            document.apply(op)
+        return document.text
+
+    async def test_concurrent_typists_converge(self):
+        host = await User.objects.acreate(email='host@example.com', username='host')
+        guest = await User.objects.acreate(email='guest@example.com', username='guest')
+        room = await Room.objects.acreate(host=host, name='pair')
+        await astore_code_version(room.id, 'ab\ncd')
+        first, sync = await self.connect(host, room.id)
+        second, _ = await self.connect(guest, room.id)
+
+        # Both typed before seeing the other's change
+        await first.send_json_to({'type': 'code_change', 'seq': sync['seq'], 'code': {
+            'from': {'line': 0, 'ch': 2}, 'to': {'line': 0, 'ch': 2}, 'text': ['XYZW'], 'clientId': 'a'}})
+        await second.send_json_to({'type': 'code_change', 'seq': sync['seq'], 'code': {
+            'from': {'line': 1, 'ch': 1}, 'to': {'line': 1, 'ch': 1}, 'text': ['Q'], 'clientId': 'b'}})
+
+        texts = [self.replay(sync['code'], await self.receive_ops(communicator, sync['seq'] + 2))
+                 for communicator in (first, second)]
+        self.assertEqual(texts, ['abXYZW\ncQd', 'abXYZW\ncQd'])
+        self.assertEqual(get_document(room.id).text, 'abXYZW\ncQd')
+        await first.disconnect()
+        await second.disconnect()
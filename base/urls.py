@@ -7,6 +7,7 @@ urlpatterns = [
     path('logout/', views.logoutUser, name="logout"),
     path('', views.home, name="home"),
     path('room/<str:pk>/', views.room, name="room"),
+    path('room/<str:pk>/messages/', views.room_messages, name="room-messages"),
     path('profile/<str:pk>/', views.userProfile, name="user-profile"),
     path('create-room/', views.createRoom, name="create-room"),
     path('update-room/<str:pk>', views.updateRoom, name="update-room"),
@@ -15,9 +16,18 @@ urlpatterns = [
     path('update-user/', views.updateUser, name="update-user"),
     path('topics/', views.topicsPage, name="topics"),
     path('activity/', views.activityPage, name="activity"),
+    path('activity/feed/', views.activity_feed, name="activity-feed"),
     path('room-code/<str:pk>/', views.roomCode, name="room-code"),
     path('room/<int:room_id>/invite/', views.invite_to_room, name='invite-to-room'),
+    path('room/<int:room_id>/invite/bulk/', views.bulk_invite_to_room, name='bulk-invite-to-room'),
     path('join/<uuid:token>/', views.join_room, name='join_room'),
     path('room-code/<int:room_id>/save-code/', views.save_code, name='save_code'),
     path('room-code/<int:room_id>/latest-code/', views.get_latest_code, name='get_latest_code'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('debug/profiling/', views.profiling_view, name='debug-profiling'),
+    path('room-code/<int:room_id>/changes/', views.code_changes, name='code-changes'),
+    path('room-code/<int:room_id>/versions/', views.code_versions, name='code-versions'),
+    path('room-code/<int:room_id>/versions/<int:version>/', views.code_version, name='code-version'),
+    path('room-code/<int:room_id>/versions/<int:from_version>/diff/<int:to_version>/',
+         views.code_diff, name='code-diff'),
 ]
\ No newline at end of file
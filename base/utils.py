@@ -1,39 +1,531 @@
+import asyncio
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import diff_match_patch as dmp_module
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from datetime import datetime
+from django.db.models import Q
+from django.db.models.functions import Coalesce, Length
+from . import codec as code_codec
+from .models import CodeSnippets
 
 dmp = dmp_module.diff_match_patch()
 
+CODE_CACHE_SIZE = getattr(settings, 'CLUST_CODE_CACHE_SIZE', 256)
+CODE_CACHE_TIMEOUT = getattr(settings, 'CLUST_CODE_CACHE_TIMEOUT', 60 * 60)
+# Bounds how long a cached latest version number can lag behind the table.
+# Every save updates it, so with a cache shared by all workers (Redis,
+# Memcached) it is current and can live long. A per-process cache only sees
+# its own process's saves, so there it expires quickly: it only decides
+# 304s for polling clients, If-Match is always checked against the table.
+SHARED_CACHE = not any(
+    backend in settings.CACHES['default']['BACKEND'] for backend in ('LocMemCache', 'DummyCache'))
+LATEST_VERSION_TIMEOUT = getattr(settings, 'CLUST_LATEST_VERSION_TIMEOUT', 60 if SHARED_CACHE else 2)
+# Attempts at claiming the next version number before giving up
+SAVE_RETRIES = getattr(settings, 'CLUST_CODE_SAVE_RETRIES', 5)
+
+MESSAGE_PAGE_SIZE = getattr(settings, 'CLUST_MESSAGE_PAGE_SIZE', 50)
+VERSION_PAGE_SIZE = getattr(settings, 'CLUST_VERSION_PAGE_SIZE', 100)
+
+# A full snapshot is written once the patch text since the last one adds up
+# to more than CHECKPOINT_RATIO times the document, both counted uncompressed
+# (but at least CHECKPOINT_MIN_BYTES), once replaying them took longer than
+# CHECKPOINT_REPLAY_SECONDS, or after CHECKPOINT_MAX_CHAIN patches.
+CHECKPOINT_RATIO = getattr(settings, 'CLUST_CODE_CHECKPOINT_RATIO', 1.0)
+CHECKPOINT_MIN_BYTES = getattr(settings, 'CLUST_CODE_CHECKPOINT_MIN_BYTES', 4096)
+CHECKPOINT_REPLAY_SECONDS = getattr(settings, 'CLUST_CODE_CHECKPOINT_REPLAY_SECONDS', 0.05)
+CHECKPOINT_MAX_CHAIN = getattr(settings, 'CLUST_CODE_CHECKPOINT_MAX_CHAIN', 200)
+
+
+class CodeCache:
+    # Reconstructed text keyed by (room_id, version_number). A version never
+    # changes once written, so entries are only evicted, or forgotten when
+    # compaction removes the version.
+    # Lookups go to the in-process LRU first and then to Django's cache.
+    def __init__(self, maxsize=CODE_CACHE_SIZE, timeout=CODE_CACHE_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cache_key(self, room_id, version_number):
+        return f'clust:code:{room_id}:{version_number}'
+
+    def get(self, room_id, version_number):
+        key = (room_id, version_number)
+        with self._lock:
+            code = self._entries.get(key)
+            if code is not None:
+                self._entries.move_to_end(key)
+                return code
+        code = cache.get(self._cache_key(room_id, version_number))
+        if code is not None:
+            self._remember(key, code)
+        return code
+
+    def set(self, room_id, version_number, code):
+        self._remember((room_id, version_number), code)
+        cache.set(self._cache_key(room_id, version_number), code, self.timeout)
+
+    async def aget(self, room_id, version_number):
+        key = (room_id, version_number)
+        with self._lock:
+            code = self._entries.get(key)
+            if code is not None:
+                self._entries.move_to_end(key)
+                return code
+        code = await cache.aget(self._cache_key(room_id, version_number))
+        if code is not None:
+            self._remember(key, code)
+        return code
+
+    async def aset(self, room_id, version_number, code):
+        self._remember((room_id, version_number), code)
+        await cache.aset(self._cache_key(room_id, version_number), code, self.timeout)
+
+    def _remember(self, key, code):
+        with self._lock:
+            self._entries[key] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def forget(self, room_id, version_numbers):
+        # Only for versions compact_code_history removed
+        with self._lock:
+            for version_number in version_numbers:
+                self._entries.pop((room_id, version_number), None)
+        cache.delete_many([self._cache_key(room_id, v) for v in version_numbers])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+code_cache = CodeCache()
+
+# Last measured time it took to replay a room's patch chain, by room id
+replay_costs = {}
+
+
+def _chain_key(room_id, version_number):
+    return f'clust:chain:{room_id}:{version_number}'
+
+
+def forget_chain_stats(room_id, version_numbers):
+    version_numbers = list(version_numbers)
+    for start in range(0, len(version_numbers), 500):
+        cache.delete_many([_chain_key(room_id, v) for v in version_numbers[start:start + 500]])
+
+
+def stored_size():
+    # Bytes a row takes in the database, whichever column holds its text
+    return Length('code_diff') + Coalesce(Length('code_blob'), 0)
+
+
+def chain_size(rows):
+    # Uncompressed patch text in (codec, len(code_diff), code_blob) rows, in
+    # the units checkpoint_due compares against len(new_code)
+    return sum(
+        length if codec == code_codec.PLAIN else len(code_codec.decode(codec, '', blob))
+        for codec, length, blob in rows
+    )
+
+
+def chain_rows(snippets, last_full, version_number):
+    return (
+        snippets
+        .filter(version_number__gt=last_full, version_number__lte=version_number)
+        .values_list('codec', Length('code_diff'), 'code_blob')
+    )
+
+
+def get_chain_stats(room, version_number):
+    # (patch text size, patch count) written since the last full snapshot at or
+    # before version_number. Kept in the cache and rolled forward on save.
+    stats = cache.get(_chain_key(room.id, version_number))
+    if stats is not None:
+        return stats
+    last_full = (
+        room.snippets
+        .filter(is_full=True, version_number__lte=version_number)
+        .order_by('-version_number')
+        .values_list('version_number', flat=True)
+        .first()
+    ) or 0
+    rows = list(chain_rows(room.snippets, last_full, version_number))
+    stats = (chain_size(rows), len(rows))
+    cache.set(_chain_key(room.id, version_number), stats, CODE_CACHE_TIMEOUT)
+    return stats
+
+
+def checkpoint_due(room_id, version_number, chain_stats, new_code, code_diff):
+    if version_number == 1:
+        return True
+    chain_bytes, chain_count = chain_stats
+    if chain_count + 1 >= CHECKPOINT_MAX_CHAIN:
+        return True
+    if chain_bytes + len(code_diff) > max(CHECKPOINT_MIN_BYTES, CHECKPOINT_RATIO * len(new_code)):
+        return True
+    return replay_costs.get(room_id, 0) > CHECKPOINT_REPLAY_SECONDS
+
+
 def get_diff(old, new):
     patches = dmp.patch_make(old, new)
     return dmp.patch_toText(patches)
 
+
 def apply_diff(old, diff_text):
     patches = dmp.patch_fromText(diff_text)
     new_text, _ = dmp.patch_apply(patches, old)
     return new_text
 
+
+def replay(room_id, snapshot, diffs):
+    # snapshot and diffs are stored (codec, code_diff, code_blob) rows. Rows
+    # are only decompressed here, one at a time as they are replayed.
+    code = code_codec.decode(*snapshot)
+    started = time.perf_counter()
+    for stored in diffs:
+        code = apply_diff(code, code_codec.decode(*stored))
+    replay_costs[room_id] = time.perf_counter() - started
+    return code
+
+
+def prepare_version(room_id, version_number, old_code, new_code, chain_stats):
+    # Everything CPU bound about a save: the diff, the checkpoint decision
+    # and compression. Returns (is_full, codec, code_diff, code_blob).
+    code_diff = get_diff(old_code, new_code) if version_number > 1 else new_code
+    is_full = checkpoint_due(room_id, version_number, chain_stats, new_code, code_diff)
+    if is_full:
+        code_diff = new_code
+    return (is_full, *code_codec.encode(code_diff))
+
+
+def next_chain_stats(room_id, chain_stats, is_full, codec, code_diff, code_blob):
+    if is_full:
+        replay_costs.pop(room_id, None)
+        return (0, 0)
+    chain_bytes, chain_count = chain_stats
+    return (chain_bytes + chain_size([(codec, len(code_diff), code_blob)]), chain_count + 1)
+
+
+def check_version_kept(upto_version, snapshot_version, diffs):
+    # compact_code_history drops versions; never answer for one of them
+    # with the text of the version before it
+    if (diffs[-1][0] if diffs else snapshot_version) != upto_version:
+        raise CodeSnippets.DoesNotExist(f'version {upto_version} does not exist')
+
+
 def reconstruct_code(room, upto_version=None):
     if upto_version is None:
         upto_version = room.snippets.latest('version_number').version_number
 
+    code = code_cache.get(room.id, upto_version)
+    if code is not None:
+        return code
+
+    # Found through the partial checkpoint index, so the replay below is
+    # bounded by the checkpoint policy no matter how long the history is
     full_snapshot = (
         room.snippets
         .filter(is_full=True, version_number__lte=upto_version)
         .order_by('-version_number')
+        .values_list('version_number', 'codec', 'code_diff', 'code_blob')
         .first()
     )
 
     if not full_snapshot:
         return ""
 
-    code = full_snapshot.code_diff
-
-    diffs = (
+    snapshot_version, *snapshot = full_snapshot
+    diffs = list(
         room.snippets
-        .filter(version_number__gt=full_snapshot.version_number, version_number__lte=upto_version)
+        .filter(version_number__gt=snapshot_version, version_number__lte=upto_version)
         .order_by('version_number')
+        .values_list('version_number', 'codec', 'code_diff', 'code_blob')
+    )
+    check_version_kept(upto_version, snapshot_version, diffs)
+    code = replay(room.id, snapshot, [stored for _, *stored in diffs])
+
+    code_cache.set(room.id, upto_version, code)
+    return code
+
+
+class VersionConflict(Exception):
+    # The caller's base version is no longer the latest one
+    def __init__(self, latest_version):
+        super().__init__(f'latest version is {latest_version}')
+        self.latest_version = latest_version
+
+
+def content_hash(code):
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def _latest_key(room_id):
+    return f'clust:code:latest:{room_id}'
+
+
+def remember_latest_version(room_id, version_number):
+    # Lets polling clients get their 304 without a query. Concurrent savers
+    # can finish out of order, so never move the cached number backwards.
+    current = cache.get(_latest_key(room_id))
+    if current is None or current < version_number:
+        cache.set(_latest_key(room_id), version_number, LATEST_VERSION_TIMEOUT)
+
+
+def latest_snippet(snippets):
+    # (version_number, content_hash) of the newest row, (0, '') when empty
+    return snippets.order_by('-version_number').values_list('version_number', 'content_hash')
+
+
+def store_code_version(room, new_code, base_version=None):
+    # Returns the version holding new_code; that is the latest version when
+    # the code did not change. Version numbers come from the unique
+    # (room, version_number) constraint: a saver that loses the race diffs
+    # again against the winner's text and retries.
+    new_hash = content_hash(new_code)
+    for _ in range(SAVE_RETRIES):
+        latest_version, latest_hash = latest_snippet(room.snippets).first() or (0, '')
+        if base_version is not None and base_version != latest_version:
+            raise VersionConflict(latest_version)
+        if latest_version and latest_hash == new_hash:
+            return latest_version
+        old_code = reconstruct_code(room, latest_version) if latest_version else ""
+        # Rows written before content hashes existed
+        if latest_version and not latest_hash and old_code == new_code:
+            return latest_version
+        version_number = latest_version + 1
+
+        chain_stats = get_chain_stats(room, latest_version) if latest_version else (0, 0)
+        is_full, codec, code_diff, code_blob = prepare_version(
+            room.id, version_number, old_code, new_code, chain_stats)
+
+        try:
+            with transaction.atomic():
+                room.snippets.create(
+                    version_number=version_number,
+                    code_diff=code_diff,
+                    codec=codec,
+                    code_blob=code_blob,
+                    content_hash=new_hash,
+                    is_full=is_full
+                )
+        except IntegrityError:
+            continue
+        # The next save diffs against this text, keep it so it never replays patches
+        code_cache.set(room.id, version_number, new_code)
+        chain_stats = next_chain_stats(room.id, chain_stats, is_full, codec, code_diff, code_blob)
+        cache.set(_chain_key(room.id, version_number), chain_stats, CODE_CACHE_TIMEOUT)
+        remember_latest_version(room.id, version_number)
+        return version_number
+    raise VersionConflict(latest_version)
+
+
+# Native async versions of the above for the async views. Queries use the
+# async ORM, and diffing, compression and replay run on PATCH_EXECUTOR so
+# the event loop keeps serving other editors meanwhile.
+PATCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'CLUST_PATCH_WORKERS', 4), thread_name_prefix='clust-patch')
+
+
+async def in_patch_executor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(PATCH_EXECUTOR, func, *args)
+
+
+async def aget_chain_stats(room_id, version_number):
+    stats = await cache.aget(_chain_key(room_id, version_number))
+    if stats is not None:
+        return stats
+    snippets = CodeSnippets.objects.filter(room_id=room_id)
+    last_full = await (
+        snippets
+        .filter(is_full=True, version_number__lte=version_number)
+        .order_by('-version_number')
+        .values_list('version_number', flat=True)
+        .afirst()
+    ) or 0
+    rows = [row async for row in chain_rows(snippets, last_full, version_number)]
+    stats = (await in_patch_executor(chain_size, rows), len(rows))
+    await cache.aset(_chain_key(room_id, version_number), stats, CODE_CACHE_TIMEOUT)
+    return stats
+
+
+async def alatest_version(room_id):
+    # None when the room has no code yet. Served from the cache when a save
+    # in this deployment recorded it, see remember_latest_version.
+    version_number = await cache.aget(_latest_key(room_id))
+    if version_number is not None:
+        return version_number
+    version_number = await (
+        CodeSnippets.objects.filter(room_id=room_id)
+        .order_by('-version_number')
+        .values_list('version_number', flat=True)
+        .afirst()
+    )
+    if version_number is not None:
+        await cache.aset(_latest_key(room_id), version_number, LATEST_VERSION_TIMEOUT)
+    return version_number
+
+
+async def aremember_latest_version(room_id, version_number):
+    current = await cache.aget(_latest_key(room_id))
+    if current is None or current < version_number:
+        await cache.aset(_latest_key(room_id), version_number, LATEST_VERSION_TIMEOUT)
+
+
+async def areconstruct_code(room_id, upto_version=None):
+    if upto_version is None:
+        upto_version = await alatest_version(room_id)
+        if upto_version is None:
+            return ""
+
+    code = await code_cache.aget(room_id, upto_version)
+    if code is not None:
+        return code
+
+    snippets = CodeSnippets.objects.filter(room_id=room_id)
+    full_snapshot = await (
+        snippets
+        .filter(is_full=True, version_number__lte=upto_version)
+        .order_by('-version_number')
+        .values_list('version_number', 'codec', 'code_diff', 'code_blob')
+        .afirst()
     )
+    if not full_snapshot:
+        return ""
 
-    for version in diffs:
-        code = apply_diff(code, version.code_diff)
+    snapshot_version, *snapshot = full_snapshot
+    diffs = [
+        row async for row in
+        snippets
+        .filter(version_number__gt=snapshot_version, version_number__lte=upto_version)
+        .order_by('version_number')
+        .values_list('version_number', 'codec', 'code_diff', 'code_blob')
+    ]
+    check_version_kept(upto_version, snapshot_version, diffs)
+    code = await in_patch_executor(replay, room_id, snapshot, [stored for _, *stored in diffs])
 
+    await code_cache.aset(room_id, upto_version, code)
     return code
+
+
+async def astore_code_version(room_id, new_code, base_version=None):
+    new_hash = await in_patch_executor(content_hash, new_code)
+    snippets = CodeSnippets.objects.filter(room_id=room_id)
+    for _ in range(SAVE_RETRIES):
+        latest_version, latest_hash = await latest_snippet(snippets).afirst() or (0, '')
+        if base_version is not None and base_version != latest_version:
+            raise VersionConflict(latest_version)
+        if latest_version and latest_hash == new_hash:
+            return latest_version
+        old_code = await areconstruct_code(room_id, latest_version) if latest_version else ""
+        if latest_version and not latest_hash and old_code == new_code:
+            return latest_version
+        version_number = latest_version + 1
+
+        chain_stats = await aget_chain_stats(room_id, latest_version) if latest_version else (0, 0)
+        is_full, codec, code_diff, code_blob = await in_patch_executor(
+            prepare_version, room_id, version_number, old_code, new_code, chain_stats)
+
+        try:
+            await snippets.acreate(
+                room_id=room_id,
+                version_number=version_number,
+                code_diff=code_diff,
+                codec=codec,
+                code_blob=code_blob,
+                content_hash=new_hash,
+                is_full=is_full
+            )
+        except IntegrityError:
+            continue
+        await code_cache.aset(room_id, version_number, new_code)
+        chain_stats = next_chain_stats(room_id, chain_stats, is_full, codec, code_diff, code_blob)
+        await cache.aset(_chain_key(room_id, version_number), chain_stats, CODE_CACHE_TIMEOUT)
+        await aremember_latest_version(room_id, version_number)
+        return version_number
+    raise VersionConflict(latest_version)
+
+
+async def achanges_since(room_id, since, latest_version):
+    # What a client holding version `since` needs to reach latest_version:
+    # {'patches': [...]} to apply in order, or {'code': ...} when patches
+    # would not be smaller than the document itself
+    latest_code = await areconstruct_code(room_id, latest_version)
+    rows = [
+        row async for row in
+        CodeSnippets.objects
+        .filter(room_id=room_id, version_number__gte=since, version_number__lte=latest_version)
+        .order_by('version_number')
+        .values_list('version_number', 'is_full', 'codec', 'code_diff', 'code_blob')
+    ]
+    # The client's version was compacted away, nothing to diff against
+    if not rows or rows[0][0] != since:
+        return {'code': latest_code}
+    rows = rows[1:]
+
+    if len(rows) == latest_version - since and not any(is_full for _, is_full, *_ in rows):
+        # Stored patches chain straight from `since`, send them as they are
+        patches = await in_patch_executor(
+            lambda: [code_codec.decode(*stored) for _, _, *stored in rows])
+    else:
+        # A snapshot or a gap in between: compose one patch instead
+        since_code = await areconstruct_code(room_id, since)
+        patches = [await in_patch_executor(get_diff, since_code, latest_code)]
+
+    if sum(len(patch) for patch in patches) >= len(latest_code):
+        return {'code': latest_code}
+    return {'patches': patches}
+
+
+def version_page(room, before=None, limit=VERSION_PAGE_SIZE):
+    # Newest `limit` versions below `before`, newest first, plus the version
+    # number to pass as `before` for the next page (None on the last page)
+    versions = room.snippets.all()
+    if before is not None:
+        versions = versions.filter(version_number__lt=before)
+    page = list(
+        versions
+        .annotate(patch_size=stored_size())
+        .order_by('-version_number')
+        .values('version_number', 'is_full', 'created_at', 'patch_size')[:limit + 1]
+    )
+    next_before = page[limit - 1]['version_number'] if len(page) > limit else None
+    return page[:limit], next_before
+
+
+def encode_cursor(message):
+    # Opaque position of a message on the (room, created, id) index
+    raw = f'{message.created.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created), int(message_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def message_page(messages, before=None, limit=MESSAGE_PAGE_SIZE):
+    # Newest `limit` messages older than the `before` cursor, oldest first,
+    # plus the cursor for the page before them (None on the last page)
+    position = decode_cursor(before) if before else None
+    if position is not None:
+        created, message_id = position
+        messages = messages.filter(Q(created__lt=created) | Q(created=created, id__lt=message_id))
+    page = list(messages.select_related('user').order_by('-created', '-id')[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    page = page[:limit]
+    page.reverse()
+    return page, next_cursor
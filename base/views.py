@@ -1,6 +1,12 @@
 from django.shortcuts import render, redirect
-from django.db.models import Q
-from django.http import HttpResponse
+from django.db.models import Q, Count, Exists, OuterRef
+from django.core.paginator import Paginator
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.core.exceptions import PermissionDenied
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+import difflib
 from .models import Room, Topic, Message, RoomInvitation, RoomMembership, User, CodeSnippets
 from .forms import RoomForm, CustomUserCreationForm
 from django.contrib import messages
@@ -11,10 +17,38 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.http import HttpResponseForbidden, HttpResponseBadRequest, JsonResponse
 from django.utils import timezone
 from django.contrib.auth.forms import UserCreationForm
-from .utils import reconstruct_code, get_diff, apply_diff
+from .utils import (
+    reconstruct_code, areconstruct_code, astore_code_version, alatest_version, achanges_since,
+    VersionConflict,
+    message_page, version_page,
+)
+from . import search, activity, invitations, metrics, permissions
+from .mailqueue import invitation_mailer
+from .profiling import profiles
 import json
 # <-- IMPORTS END -->
 
+ROOM_PAGE_SIZE = getattr(settings, 'CLUST_ROOM_PAGE_SIZE', 20)
+# Ask room-code clients to negotiate the binary code protocol (base/wire.py)
+COMPACT_WIRE = getattr(settings, 'CLUST_COMPACT_WIRE', False)
+# When set, /metrics wants an "Authorization: Bearer <token>" header
+METRICS_TOKEN = getattr(settings, 'CLUST_METRICS_TOKEN', None)
+
+def feed_rooms(rooms):
+    # Everything feed_component.html reads, fetched in the feed query itself
+    return rooms.select_related('host', 'topic').annotate(
+        participant_count=Count('participants', distinct=True)
+    )
+
+def join_participants(room, user):
+    # Online state lives in base.presence; the M2M only records that the
+    # user took part at least once, so it is written on the first post only
+    if not room.participants.filter(id=user.id).exists():
+        room.participants.add(user)
+
+def topics_with_counts():
+    return Topic.objects.annotate(room_count=Count('room'))
+
 def loginPage(request):
     page = 'login'
     if request.user.is_authenticated:
@@ -56,73 +90,97 @@ def registerPage(request):
             messages.error(request, 'An error occured')
     return render(request, 'base/login_register.html', context)
 
+@metrics.timed_view('home')
 def home(request):
     q = request.GET.get('q') if request.GET.get('q') != None else ''
 
+    rooms = Room.objects.all()
+    if q:
+        # Ranked hits from the search index instead of icontains scans
+        room_ids = search.search_ids(search.ROOM, q)
+        rooms = search.ranked(rooms, room_ids)
     if request.user.is_authenticated:
-        rooms = Room.objects.filter(
-            (Q(topic__name__icontains=q) |
-                Q(name__icontains=q) |
-                Q(description__icontains=q))
-            &
-            (Q(is_private=False) | Q(memberships__user=request.user))
-        )
+        # EXISTS rather than a join on memberships, which repeated rooms once per member
+        is_member = RoomMembership.objects.filter(room=OuterRef('pk'), user=request.user)
+        rooms = rooms.filter(Q(is_private=False) | Q(Exists(is_member)))
     else:
-        rooms = Room.objects.filter(
-            Q(topic__name__icontains=q) |
-            Q(name__icontains=q) |
-            Q(description__icontains=q),
-            Q(is_private=False)
-        )
-    topics = Topic.objects.all()[0:5]
-    room_count = rooms.count()
-    room_messages = Message.objects.filter(Q(room__topic__name__icontains=q))[0:5]
-    context = {'rooms' : rooms, 'topics': topics, 'room_count': room_count,
-    'room_messages' : room_messages}
+        rooms = rooms.filter(is_private=False)
+
+    paginator = Paginator(feed_rooms(rooms), ROOM_PAGE_SIZE)
+    page = paginator.get_page(request.GET.get('page'))
+    topics = topics_with_counts()[0:5]
+    room_count = paginator.count
+    # Search hits go through the same visibility filter as the activity feed
+    room_messages = activity.visible_messages(request.user).select_related('user')
+    if q:
+        message_ids = search.search_ids(search.MESSAGE, q)
+        room_messages = room_messages.filter(Q(room_id__in=room_ids) | Q(id__in=message_ids))
+    room_messages = room_messages[0:5]
+    context = {'rooms' : page, 'page': page, 'topics': topics, 'room_count': room_count,
+    'room_messages' : room_messages, 'q': q}
     return render(request, 'base/home.html', context)
+@metrics.timed_view('room')
 def room(request, pk):
-    try:
-        room = Room.objects.get(id=pk)
-        
-        # Check if user has membership
-        try:
-            membership = RoomMembership.objects.get(user=request.user, room=room)
-            is_member = membership.role in ['ADMIN', 'MEMBER']
-        except RoomMembership.DoesNotExist:
-            is_member = False
-        
-        # Allow access if user is member or room is public
-        if is_member or not room.is_private:
-            room_messages = room.message_set.all().order_by('created')
-            participants = room.participants.all()
-            
-            if request.method == 'POST':
-                message = Message.objects.create(
-                    user=request.user,
-                    room=room,
-                    body=request.POST.get('body')
-                )
-                room.participants.add(request.user)
-                return redirect('room', pk=room.id)
-            
-            context = {
-                'room': room,
-                'room_messages': room_messages,
-                'participants': participants,
-                'is_member': is_member
-            }
-            return render(request, 'base/room.html', context)
-        else:
-            return HttpResponseForbidden("You are not allowed to access this room!")
-            
-    except Room.DoesNotExist:
+    access = permissions.room_access(request.user, pk)
+    if access is None:
         return HttpResponseForbidden("Room does not exist!")
+    # Allow access if user is member or room is public
+    if not permissions.can_view(access):
+        return HttpResponseForbidden("You are not allowed to access this room!")
+
+    room = Room.objects.get(id=pk)
+    # Only the latest page is rendered, older ones come from room_messages
+    room_messages, older_cursor = message_page(room.message_set.all())
+    participants = room.participants.all()
+
+    if request.method == 'POST':
+        message = Message.objects.create(
+            user=request.user,
+            room=room,
+            body=request.POST.get('body')
+        )
+        join_participants(room, request.user)
+        return redirect('room', pk=room.id)
+
+    context = {
+        'room': room,
+        'room_messages': room_messages,
+        'older_cursor': older_cursor,
+        'participants': participants,
+        'is_member': permissions.is_member(access)
+    }
+    return render(request, 'base/room.html', context)
+
+@metrics.timed_view('room_messages')
+def room_messages(request, pk):
+    access = permissions.room_access(request.user, pk)
+    if access is None:
+        raise Http404
+    if not permissions.can_view(access):
+        return HttpResponseForbidden("You are not allowed to access this room!")
+
+    messages_page, older_cursor = message_page(
+        Message.objects.filter(room_id=pk), before=request.GET.get('before')
+    )
+    return JsonResponse({
+        'messages': [
+            {
+                'id': message.id,
+                'user_id': message.user_id,
+                'username': message.user.username,
+                'body': message.body,
+                'created': message.created.isoformat(),
+            }
+            for message in messages_page
+        ],
+        'next': older_cursor,
+    })
 
 def userProfile(request, pk):
     user = User.objects.get(id=pk)
-    rooms = user.room_set.all()
-    room_messages = user.message_set.all()
-    topics = Topic.objects.all()
+    rooms = feed_rooms(user.room_set.all())
+    room_messages = user.message_set.select_related('user', 'room')
+    topics = topics_with_counts()
     context = {'user' : user, 'rooms' : rooms, 'room_messages' : room_messages, 'topics' : topics}
     return render(request, 'base/profile.html', context)
 @login_required(login_url='login')
@@ -205,63 +263,222 @@ def updateUser(request):
             return redirect('user-profile', pk=user.id)
     return render(request, 'base/update-user.html', {'form' : form})
 
-@csrf_exempt
-def save_code(request, room_id):
+async def check_room_access_async(request, room_id):
+    access = await permissions.aroom_access(await request.auser(), room_id)
+    if access is None:
+        raise Http404
+    if not permissions.can_view(access):
+        raise PermissionDenied
 
-    room = get_object_or_404(Room, id=room_id)
+def version_etag(room_id, version_number):
+    # Tag of the latest code, also the If-Match base for saves. It names the
+    # version number only so polling can revalidate from the cache without a
+    # query; the history endpoints add the content hash (see version_hashes),
+    # so their tags for the same version differ from this one.
+    return quote_etag(f'{room_id}-{version_number}')
+
+# Base version for an If-Match that names no version of this room. No
+# version matches it, so the save fails with 412 and the latest version.
+NO_VERSION = -1
+
+def if_match_version(request, room_id):
+    # The base version named by If-Match, None when absent or "*". If-Match
+    # uses the strong comparison (RFC 9110 13.1.1), so weak tags never match.
+    header = request.headers.get('If-Match')
+    if not header:
+        return None
+    etags = parse_etags(header)
+    if '*' in etags:
+        return None
+    for etag in etags:
+        if etag.startswith('W/'):
+            continue
+        prefix, _, version = etag.strip('"').rpartition('-')
+        if prefix == str(room_id) and version.isdigit():
+            return int(version)
+    return NO_VERSION
+
+# Both code endpoints are native async views: no hop through the sync
+# thread pool, async ORM queries, and diff work on utils.PATCH_EXECUTOR
+@csrf_exempt
+@metrics.timed_view('save_code')
+async def save_code(request, room_id):
+    await check_room_access_async(request, room_id)
     data = json.loads(request.body)
     new_code = data.get("code")
 
     try:
-        latest_version = room.snippets.latest('version_number')
-        old_code = reconstruct_code(room)
-        version_number = latest_version.version_number + 1
-    except CodeSnippets.DoesNotExist:
-        old_code = ""
-        version_number = 1
-
-    if version_number % 10 == 0 or version_number == 1:
-        code_diff = new_code
-        is_full = True
-    else:
-        code_diff = get_diff(old_code, new_code)
-        is_full = False
-
-    CodeSnippets.objects.create(
-        room=room,
-        version_number=version_number,
-        code_diff=code_diff,
-        is_full=is_full
+        version_number = await astore_code_version(
+            room_id, new_code, base_version=if_match_version(request, room_id))
+    except VersionConflict as conflict:
+        response = JsonResponse(
+            {"status": "conflict", "version": conflict.latest_version}, status=412)
+        response.headers['ETag'] = version_etag(room_id, conflict.latest_version)
+        return response
+
+    response = JsonResponse({"status": "success", "version": version_number})
+    response.headers['ETag'] = version_etag(room_id, version_number)
+    return response
+
+@metrics.timed_view('get_latest_code')
+async def get_latest_code(request, room_id):
+    await check_room_access_async(request, room_id)
+    version_number = await alatest_version(room_id) or 0
+    etag = version_etag(room_id, version_number)
+    # Polling clients that already have this version cost no query at all
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        code = await areconstruct_code(room_id, version_number) if version_number else ""
+        response = JsonResponse({"code": code, "version": version_number})
+    response.headers['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def check_room_access(request, room_id):
+    access = permissions.room_access(request.user, room_id)
+    if access is None:
+        raise Http404
+    if not permissions.can_view(access):
+        raise PermissionDenied
+
+def version_hashes(room_id, versions):
+    # Content hash per requested version, 404 when one is not stored.
+    # compact_code_history deletes versions and rewrites rows, so history
+    # ETags come from the rows rather than the URL and are revalidated.
+    hashes = dict(
+        CodeSnippets.objects.filter(room_id=room_id, version_number__in=versions)
+        .values_list('version_number', 'content_hash')
     )
+    if len(hashes) != len(set(versions)):
+        raise Http404
+    return hashes
 
-    return JsonResponse({"status": "success", "version": version_number})
+def history_response(request, etag, build):
+    # A matching If-None-Match is answered without replaying any history
+    etag = quote_etag(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = build()
+    response.headers['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
-def get_latest_code(request, room_id):
+@metrics.timed_view('code_changes')
+async def code_changes(request, room_id):
+    # Delta sync: ?since=<version the client holds>
+    await check_room_access_async(request, room_id)
+    since = request.GET.get('since', '')
+    if not since.isdigit():
+        return HttpResponseBadRequest("since must be a version number")
+    since = int(since)
+    version_number = await alatest_version(room_id) or 0
+    etag = version_etag(room_id, version_number)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if since == version_number:
+            changes = {'patches': []}
+        elif 0 < since < version_number:
+            changes = await achanges_since(room_id, since, version_number)
+        else:
+            code = await areconstruct_code(room_id, version_number) if version_number else ""
+            changes = {'code': code}
+        response = JsonResponse({'since': since, 'version': version_number, **changes})
+    response.headers['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+@metrics.timed_view('code_versions')
+def code_versions(request, room_id):
+    check_room_access(request, room_id)
     room = get_object_or_404(Room, id=room_id)
-    code = reconstruct_code(room)
-    return JsonResponse({"code": code})
+    before = request.GET.get('before')
+    versions, next_before = version_page(room, before=int(before) if before and before.isdigit() else None)
+    return JsonResponse({
+        'versions': [
+            {
+                'version': version['version_number'],
+                'is_full': version['is_full'],
+                'created': version['created_at'].isoformat(),
+                'patch_size': version['patch_size'],
+            }
+            for version in versions
+        ],
+        'next': next_before,
+    })
+
+@metrics.timed_view('code_version')
+def code_version(request, room_id, version):
+    check_room_access(request, room_id)
+
+    hashes = version_hashes(room_id, [version])
+
+    def build():
+        room = get_object_or_404(Room, id=room_id)
+        return JsonResponse({'version': version, 'code': reconstruct_code(room, version)})
+
+    return history_response(request, f'{room_id}-{version}-{hashes[version][:16]}', build)
+
+@metrics.timed_view('code_diff')
+def code_diff(request, room_id, from_version, to_version):
+    check_room_access(request, room_id)
+
+    hashes = version_hashes(room_id, [from_version, to_version])
+
+    def build():
+        room = get_object_or_404(Room, id=room_id)
+        diff = difflib.unified_diff(
+            reconstruct_code(room, from_version).splitlines(keepends=True),
+            reconstruct_code(room, to_version).splitlines(keepends=True),
+            fromfile=f'v{from_version}',
+            tofile=f'v{to_version}',
+        )
+        return JsonResponse({'from': from_version, 'to': to_version, 'diff': ''.join(diff)})
 
+    etag = f'{room_id}-{from_version}-{hashes[from_version][:16]}-{to_version}-{hashes[to_version][:16]}'
+    return history_response(request, etag, build)
+
+@metrics.timed_view('topics')
 def topicsPage(request):
     q = request.GET.get('q') if request.GET.get('q') != None else ''
-    topics = Topic.objects.filter(name__icontains=q)
+    topics = topics_with_counts()
+    if q:
+        topics = search.ranked(topics, search.search_ids(search.TOPIC, q))
     context = {'topics' : topics }
     return render(request, 'base/topics.html', context)
 
+@metrics.timed_view('activity')
 def activityPage(request):
-    room_messages = Message.objects.all()
-    return render(request, 'base/activity.html', {'room_messages' : room_messages })
+    room_messages, older_cursor = activity.first_page(request.user)
+    # Newest first, new items are pushed over ws/activity/
+    context = {'room_messages' : room_messages[::-1], 'older_cursor' : older_cursor}
+    return render(request, 'base/activity.html', context)
+
+@metrics.timed_view('activity_feed')
+def activity_feed(request):
+    page, older_cursor = activity.activity_page(request.user, before=request.GET.get('before'))
+    return JsonResponse({
+        'items': [
+            activity.serialize(message, message.user.username, message.room.name)
+            for message in reversed(page)
+        ],
+        'next': older_cursor,
+    })
+@metrics.timed_view('room_code')
 def roomCode(request, pk):
-    room = Room.objects.get(id=pk)
-    room_messages = room.message_set.all().order_by('created')
+    room = get_object_or_404(Room, id=pk)
+    if not permissions.can_view(permissions.room_access(request.user, pk)):
+        return HttpResponseForbidden("You are not allowed to access this room!")
+    room_messages, older_cursor = message_page(room.message_set.all())
     participants = room.participants.all()
-    context = {'room' : room, 'room_messages' : room_messages, 'participants' : participants}
+    context = {'room' : room, 'room_messages' : room_messages, 'older_cursor' : older_cursor,
+    'participants' : participants, 'compact_wire' : COMPACT_WIRE}
     if request.method == 'POST':
         message = Message.objects.create(
             user = request.user,
             room = room,
             body = request.POST.get('body')
         )
-        room.participants.add(request.user)
+        join_participants(room, request.user)
     return render(request, 'base/room-code.html', context)
 
 @login_required(login_url='login')
@@ -269,32 +486,52 @@ def invite_to_room(request, room_id):
     if request.method == 'POST':
         room = get_object_or_404(Room, id=room_id)
         
-        try:
-            print(request.user)
-            print(room)
-            membership = RoomMembership.objects.get(user=request.user, room=room)
-            if membership.role not in ['ADMIN']:
-                return HttpResponseForbidden("You don't have permission to invite users")
-            
-            email = request.POST.get('email')
-            if not email:
-                return HttpResponseBadRequest("Email is required")
-            
-            invitation = RoomInvitation.objects.create(
-                room=room,
-                email=email,
-                created_by=request.user
-            )
-            
-            invitation.send_invitation_email(request)
-            
-            return JsonResponse({
-                'status': 'success',
-                'message': f'Invitation sent to {email}'
-            })
-            
-        except RoomMembership.DoesNotExist:
+        access = permissions.room_access(request.user, room_id)
+        if not permissions.is_member(access):
             return HttpResponseForbidden("You are not a member of this room")
+        if not permissions.is_admin(access):
+            return HttpResponseForbidden("You don't have permission to invite users")
+
+        email = request.POST.get('email')
+        if not email:
+            return HttpResponseBadRequest("Email is required")
+
+        invitation = RoomInvitation.objects.create(
+            room=room,
+            email=email,
+            created_by=request.user
+        )
+
+        # Sent by the mail queue once the invitation is committed
+        invitation_mailer.enqueue_on_commit([invitation.id], request.build_absolute_uri('/'))
+
+        return JsonResponse({
+            'status': 'success',
+            'message': f'Invitation queued for {email}'
+        })
+
+@login_required(login_url='login')
+def bulk_invite_to_room(request, room_id):
+    # Addresses come from `emails` (pasted list) and/or a CSV `file`
+    if request.method != 'POST':
+        return HttpResponseBadRequest("POST required")
+    room = get_object_or_404(Room, id=room_id)
+    if not permissions.is_admin(permissions.room_access(request.user, room_id)):
+        return HttpResponseForbidden("You don't have permission to invite users")
+
+    emails = invitations.split_emails(request.POST.get('emails', ''))
+    if 'file' in request.FILES:
+        emails += invitations.read_csv_emails(request.FILES['file'])
+    if not emails:
+        return HttpResponseBadRequest("Emails are required")
+    try:
+        result = invitations.bulk_invite(
+            room, request.user, emails, request.build_absolute_uri('/'),
+            add_existing=request.POST.get('add_existing') in ('1', 'true', 'on'),
+        )
+    except invitations.TooManyEmails as exc:
+        return HttpResponseBadRequest(str(exc))
+    return JsonResponse({'status': 'success', **result})
 
 def join_room(request, token):
     invitation = get_object_or_404(RoomInvitation, token=token)
@@ -328,3 +565,14 @@ def join_room(request, token):
     invitation.save()
     
     return redirect('room', pk=invitation.room.id)
+
+def metrics_view(request):
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return HttpResponseForbidden("Metrics token required")
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def profiling_view(request):
+    # Rolling per-view numbers from base.profiling.QueryProfilingMiddleware
+    if not (settings.DEBUG or request.user.is_staff):
+        return HttpResponseForbidden("Staff only")
+    return JsonResponse(profiles.snapshot())
@@ -0,0 +1,114 @@
+import struct
+
+# Opt-in websocket subprotocol for ws/room-code/. Code ops travel as binary
+# frames with interned usernames and client ids; every other message (sync,
+# chat, presence) stays JSON text, so both protocols share one consumer.
+COMPACT_PROTOCOL = 'clust.compact.v1'
+
+# Server -> client
+CODE_BATCH = 0x01
+# Client -> server
+CODE_CHANGE = 0x02
+HELLO = 0x03
+
+# Strings a room's table holds before it starts over. Clients overwrite ids
+# as they are redefined, so a reset needs no extra frame.
+INTERN_LIMIT = 4096
+# Client ids are opaque tokens (a UUID in codeWebsocket.js)
+MAX_CLIENT_ID = 64
+
+_u16 = struct.Struct('>H')
+_definition = struct.Struct('>HH')
+_op = struct.Struct('>IHHIIIII')
+_change = struct.Struct('>BIIIII')
+
+
+class WireError(ValueError):
+    pass
+
+
+class InternTable:
+    # Room-wide string ids shared by every compact client in the room. New
+    # strings are defined inside the frame that first uses them, and joining
+    # clients get the whole table with their code_sync.
+    def __init__(self, limit=INTERN_LIMIT):
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, value, definitions):
+        value = str(value) if value else ''
+        string_id = self.ids.get(value)
+        if string_id is None:
+            if len(self.strings) >= self.limit:
+                raise WireError('intern table full')
+            string_id = len(self.strings)
+            self.ids[value] = string_id
+            self.strings.append(value)
+            definitions.append((string_id, value))
+        return string_id
+
+
+def clean_client_id(value):
+    # Client ids are echoed to every socket in the room, keep them short strings
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    return str(value)[:MAX_CLIENT_ID]
+
+
+def encode_code_batch(ops, table):
+    # Raises WireError when the batch cannot be encoded; the table is reset
+    # then, since clients never see the definitions this frame would carry
+    if len(table.strings) + 2 * len(ops) > table.limit:
+        table.reset()
+    try:
+        return _encode_code_batch(ops, table)
+    except (WireError, struct.error, TypeError, KeyError, UnicodeError) as exc:
+        table.reset()
+        raise WireError(f'cannot encode code_batch: {exc}') from exc
+
+
+def _encode_code_batch(ops, table):
+    definitions = []
+    body = []
+    for op in ops:
+        text = '\n'.join(op['text']).encode()
+        body.append(_op.pack(
+            op['seq'],
+            table.intern(op.get('username'), definitions),
+            table.intern(op.get('clientId'), definitions),
+            op['from']['line'], op['from']['ch'],
+            op['to']['line'], op['to']['ch'],
+            len(text),
+        ))
+        body.append(text)
+
+    head = [bytes([CODE_BATCH]), _u16.pack(len(definitions))]
+    for string_id, value in definitions:
+        encoded = value.encode()
+        head.append(_definition.pack(string_id, len(encoded)))
+        head.append(encoded)
+    head.append(_u16.pack(len(ops)))
+    return b''.join(head + body)
+
+
+def decode_client_frame(data):
+    # Returns ('hello', client_id) or ('code_change', base_seq, change)
+    if not data:
+        raise WireError('empty frame')
+    if data[0] == HELLO:
+        return 'hello', clean_client_id(data[1:].decode())
+    if data[0] == CODE_CHANGE:
+        if len(data) < _change.size:
+            raise WireError('short code_change frame')
+        _, base_seq, from_line, from_ch, to_line, to_ch = _change.unpack_from(data)
+        text = data[_change.size:].decode()
+        return 'code_change', base_seq, {
+            'from': {'line': from_line, 'ch': from_ch},
+            'to': {'line': to_line, 'ch': to_ch},
+            'text': text.split('\n'),
+        }
+    raise WireError(f'unknown frame type {data[0]}')
@@ -0,0 +1,159 @@
+import asyncio
+import atexit
+import logging
+
+from django.conf import settings
+
+from . import metrics
+from .models import Message, Room, User
+from .signals import messages_created
+
+# Flush once this many messages are waiting...
+BATCH_SIZE = getattr(settings, 'CLUST_MESSAGE_BATCH_SIZE', 100)
+# ...or once the oldest waiting message is this many seconds old
+FLUSH_INTERVAL = getattr(settings, 'CLUST_MESSAGE_FLUSH_INTERVAL', 0.5)
+# Hard cap on buffered messages; enqueue waits for a flush when it is reached
+MAX_BUFFER = getattr(settings, 'CLUST_MESSAGE_MAX_BUFFER', 10000)
+
+logger = logging.getLogger(__name__)
+
+
+def write_messages(batch):
+    # Users and rooms were resolved at connect time; only drop messages for
+    # users and rooms deleted since, so one bad row cannot fail the whole batch
+    room_ids = {room_id for _, room_id, _ in batch}
+    user_ids = {user_id for user_id, _, _ in batch}
+    rooms = set(Room.objects.filter(id__in=room_ids).values_list('id', flat=True))
+    users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    messages = [
+        Message(user_id=user_id, room_id=room_id, body=body)
+        for user_id, room_id, body in batch
+        if room_id in rooms and user_id in users
+    ]
+    created = Message.objects.bulk_create(messages, batch_size=BATCH_SIZE)
+    messages_created.send(sender=Message, messages=created)
+    return created
+
+
+awrite_messages = metrics.timed_database_sync_to_async(write_messages)
+
+
+class MessageWriteBehind:
+    # Per-process buffer between the websocket consumers and the database.
+    # Consumers broadcast first and enqueue afterwards; the buffer is written
+    # with bulk_create on a size or time trigger and drained at exit.
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_buffer=MAX_BUFFER):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = []
+        # Messages at the front of the buffer that already failed one write
+        self._retried = 0
+        self._timer = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failures = 0
+        self.high_watermark = 0
+
+    async def enqueue(self, user_id, room_id, body):
+        if not user_id or not body:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            await self.flush()
+        self._buffer.append((user_id, int(room_id), body))
+        self.enqueued += 1
+        self.high_watermark = max(self.high_watermark, len(self._buffer))
+
+        if len(self._buffer) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        # Swapping the buffer is atomic on the event loop, so concurrent
+        # flushes just write disjoint batches in order
+        batch, self._buffer = self._buffer, []
+        retried, self._retried = self._retried, 0
+        if not batch:
+            return
+        try:
+            created = await awrite_messages(batch)
+        except Exception:
+            self._requeue(batch, retried)
+            logger.exception('Failed to write %d chat messages', len(batch))
+            self._schedule()
+            return
+        self._written(batch, created)
+
+    def flush_sync(self):
+        batch, self._buffer = self._buffer, []
+        self._retried = 0
+        if not batch:
+            return
+        try:
+            created = write_messages(batch)
+        except Exception:
+            self.failures += 1
+            self.dropped += len(batch)
+            logger.exception('Dropped %d chat messages at shutdown', len(batch))
+            return
+        self._written(batch, created)
+
+    def _written(self, batch, created):
+        self.flushes += 1
+        self.written += len(created)
+        self.dropped += len(batch) - len(created)
+
+    def _requeue(self, batch, retried):
+        # Keep the failed batch for one more flush, as far as the buffer
+        # allows. Messages that failed twice are dropped, so a row the
+        # database keeps rejecting cannot stall every write behind it.
+        self.failures += 1
+        if retried:
+            logger.error('Dropped %d chat messages that failed to write twice', retried)
+            self.dropped += retried
+            batch = batch[retried:]
+        room = max(self.max_buffer - len(self._buffer), 0)
+        self.dropped += max(len(batch) - room, 0)
+        self._buffer[:0] = batch[:room]
+        self._retried += min(len(batch), room)
+
+    def stats(self):
+        return {
+            'depth': len(self._buffer),
+            'high_watermark': self.high_watermark,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+
+message_writer = MessageWriteBehind()
+atexit.register(message_writer.flush_sync)
+
+
+@metrics.register_collector
+def collect_message_writer():
+    stats = message_writer.stats()
+    return [
+        ('clust_message_queue_depth', 'gauge', 'Chat messages waiting to be written.',
+         [('', {}, stats['depth'])]),
+        ('clust_message_queue_high_watermark', 'gauge', 'Most chat messages ever waiting at once.',
+         [('', {}, stats['high_watermark'])]),
+        ('clust_message_queue_messages_total', 'counter', 'Chat messages through the write-behind queue.',
+         [('', {'outcome': outcome}, stats[outcome]) for outcome in ('enqueued', 'written', 'dropped')]),
+        ('clust_message_queue_flushes_total', 'counter', 'Write-behind flushes by outcome.',
+         [('', {'outcome': 'written'}, stats['flushes']), ('', {'outcome': 'failed'}, stats['failures'])]),
+    ]
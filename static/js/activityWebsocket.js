@@ -0,0 +1,78 @@
+class ActivityFeed {
+  constructor(feedUrl, olderCursor) {
+    this.feedUrl = feedUrl;
+    this.olderCursor = olderCursor;
+    this.loadingOlder = false;
+    this.socket = null;
+    this.container = document.getElementById("activity-feed");
+  }
+
+  connect() {
+    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
+    this.socket = new WebSocket(`${protocol}//${window.location.host}/ws/activity/`);
+
+    this.socket.onmessage = (event) => {
+      try {
+        this.container.insertBefore(
+          this.buildItem(JSON.parse(event.data)),
+          this.container.firstChild
+        );
+      } catch (error) {
+        console.error("Error parsing activity:", error);
+      }
+    };
+
+    this.socket.onclose = () => {
+      console.log("Activity connection closed");
+    };
+
+    window.addEventListener("scroll", () => {
+      if (window.innerHeight + window.scrollY >= document.body.offsetHeight - 200) {
+        this.loadOlder();
+      }
+    });
+  }
+
+  async loadOlder() {
+    if (!this.olderCursor || this.loadingOlder) return;
+    this.loadingOlder = true;
+    try {
+      const res = await fetch(`${this.feedUrl}?before=${encodeURIComponent(this.olderCursor)}`);
+      const data = await res.json();
+      data.items.forEach((item) => this.container.appendChild(this.buildItem(item)));
+      this.olderCursor = data.next || "";
+    } catch (error) {
+      console.error("Error loading activity:", error);
+    } finally {
+      this.loadingOlder = false;
+    }
+  }
+
+  buildItem(item) {
+    const element = document.createElement("div");
+    element.classList.add("activities__box");
+    element.innerHTML = `
+      <div class="activities__boxHeader roomListRoom__header">
+        <a href="/profile/${item.user_id}/" class="roomListRoom__author">
+          <div class="avatar avatar--small">
+            <img src="https://randomuser.me/api/portraits/women/11.jpg" />
+          </div>
+          <p><span class="activity-user"></span> <span class="activity-date"></span></p>
+        </a>
+      </div>
+      <div class="activities__boxContent">
+        <p>replied to post “<a href="/room/${item.room_id}/" class="activity-room"></a>”</p>
+        <div class="activities__boxRoomContent"></div>
+      </div>`;
+    element.querySelector(".activity-user").textContent = `@${item.username}`;
+    element.querySelector(".activity-date").textContent = new Date(item.created).toLocaleString();
+    element.querySelector(".activity-room").textContent = item.room_name;
+    element.querySelector(".activities__boxRoomContent").textContent = item.body.slice(0, 50);
+    return element;
+  }
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+  const feed = new ActivityFeed(ACTIVITY_FEED_URL, ACTIVITY_OLDER_CURSOR);
+  feed.connect();
+});
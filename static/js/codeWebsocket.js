@@ -1,3 +1,57 @@
+// Binary code frames, see base/wire.py
+const COMPACT_PROTOCOL = "clust.compact.v1";
+const FRAME_CODE_BATCH = 0x01;
+const FRAME_CODE_CHANGE = 0x02;
+const FRAME_HELLO = 0x03;
+
+// Offsets and {line, ch} positions, the same way base/documents.py does it
+function posToIndex(text, pos) {
+  let index = 0;
+  for (let line = 0; line < pos.line; line++) {
+    const newline = text.indexOf("\n", index);
+    if (newline === -1) return text.length;
+    index = newline + 1;
+  }
+  let lineEnd = text.indexOf("\n", index);
+  if (lineEnd === -1) lineEnd = text.length;
+  return Math.min(index + pos.ch, lineEnd);
+}
+
+function indexToPos(text, index) {
+  const before = text.slice(0, index);
+  const lineStart = before.lastIndexOf("\n") + 1;
+  return { line: before.split("\n").length - 1, ch: index - lineStart };
+}
+
+// Ops here are {start, end, text} on flat offsets
+function applyOp(text, op) {
+  return text.slice(0, op.start) + op.text + text.slice(op.end);
+}
+
+function transformIndex(index, op) {
+  if (index < op.start) return index;
+  if (index >= op.end) return index + op.text.length - (op.end - op.start);
+  return op.start + op.text.length;
+}
+
+function transformOp(op, applied) {
+  const start = transformIndex(op.start, applied);
+  return { start, end: Math.max(transformIndex(op.end, applied), start), text: op.text };
+}
+
+// The single replacement that turns `before` into `after`
+function diffText(before, after) {
+  let start = 0;
+  while (start < before.length && start < after.length && before[start] === after[start]) start++;
+  let end = 0;
+  while (
+    end < before.length - start &&
+    end < after.length - start &&
+    before[before.length - 1 - end] === after[after.length - 1 - end]
+  ) end++;
+  return { start, end: before.length - end, text: after.slice(start, after.length - end) };
+}
+
 class RoomWebSocket {
   constructor(roomId, username, csrfToken, codeEditor) {
     this.roomId = roomId;
@@ -11,6 +65,18 @@ class RoomWebSocket {
     this.messageInput = document.getElementById("message-input");
     this.codeEditor = codeEditor;
     this.lock = false;
+    // The document as the server has it at `seq`. The editor holds that plus
+    // local edits; one local op at a time is in flight, the rest is sent once
+    // the server echoes it back.
+    this.seq = 0;
+    this.serverText = null;
+    this.inflight = null;
+    // Opt in with `const COMPACT_WIRE = true` before this script
+    this.compact = typeof COMPACT_WIRE !== "undefined" && COMPACT_WIRE;
+    this.compactActive = false;
+    this.interned = [];
+    this.encoder = new TextEncoder();
+    this.decoder = new TextDecoder();
     this.clientId = sessionStorage.getItem("clientId") || crypto.randomUUID();
     sessionStorage.setItem("clientId", this.clientId);
   }
@@ -19,10 +85,26 @@ class RoomWebSocket {
     const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
     const socketUrl = `${protocol}//${window.location.host}/ws/room-code/${this.roomId}/`;
 
-    this.socket = new WebSocket(socketUrl);
+    this.socket = this.compact
+      ? new WebSocket(socketUrl, [COMPACT_PROTOCOL])
+      : new WebSocket(socketUrl);
+    this.socket.binaryType = "arraybuffer";
 
     this.socket.onopen = () => {
       console.log("WebSocket connection established");
+      // Servers without the compact protocol just accept plain JSON
+      this.compactActive = this.socket.protocol === COMPACT_PROTOCOL;
+      if (this.compactActive) {
+        const clientId = this.encoder.encode(this.clientId);
+        const hello = new Uint8Array(clientId.length + 1);
+        hello[0] = FRAME_HELLO;
+        hello.set(clientId, 1);
+        this.socket.send(hello);
+      }
+      // Keeps this socket counted as online, see base/presence.py
+      this.heartbeat = setInterval(() => {
+        this.socket.send(JSON.stringify({ type: "heartbeat" }));
+      }, 20000);
     };
 
     this.socket.onmessage = (event) => {
@@ -31,6 +113,7 @@ class RoomWebSocket {
 
     this.socket.onclose = () => {
       console.log("WebSocket connection closed");
+      clearInterval(this.heartbeat);
       // Optional: Attempt to reconnect
       // setTimeout(() => this.connect(), 1000);
     };
@@ -61,25 +144,84 @@ class RoomWebSocket {
   }
 
   sendCodeChange(codeContent) {
-    if (codeContent) {
+    if (codeContent && this.compactActive) {
+      const text = this.encoder.encode(codeContent.text.join("\n"));
+      const frame = new Uint8Array(21 + text.length);
+      const view = new DataView(frame.buffer);
+      view.setUint8(0, FRAME_CODE_CHANGE);
+      view.setUint32(1, this.seq);
+      view.setUint32(5, codeContent.from.line);
+      view.setUint32(9, codeContent.from.ch);
+      view.setUint32(13, codeContent.to.line);
+      view.setUint32(17, codeContent.to.ch);
+      frame.set(text, 21);
+      this.socket.send(frame);
+    } else if (codeContent) {
       this.socket.send(
         JSON.stringify({
           type: "code_change",
           code: codeContent,
+          seq: this.seq,
           username: this.username,
         })
       );
     }
   }
 
+  decodeCodeBatch(buffer) {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+    let offset = 1;
+    const definitions = view.getUint16(offset);
+    offset += 2;
+    for (let i = 0; i < definitions; i++) {
+      const id = view.getUint16(offset);
+      const length = view.getUint16(offset + 2);
+      offset += 4;
+      this.interned[id] = this.decoder.decode(bytes.subarray(offset, offset + length));
+      offset += length;
+    }
+    const count = view.getUint16(offset);
+    offset += 2;
+    const ops = [];
+    for (let i = 0; i < count; i++) {
+      const op = {
+        seq: view.getUint32(offset),
+        username: this.interned[view.getUint16(offset + 4)],
+        clientId: this.interned[view.getUint16(offset + 6)],
+        from: { line: view.getUint32(offset + 8), ch: view.getUint32(offset + 12) },
+        to: { line: view.getUint32(offset + 16), ch: view.getUint32(offset + 20) },
+      };
+      const length = view.getUint32(offset + 24);
+      offset += 28;
+      op.text = this.decoder.decode(bytes.subarray(offset, offset + length)).split("\n");
+      offset += length;
+      ops.push(op);
+    }
+    return ops;
+  }
+
   handleIncomingMessage(event) {
+    if (event.data instanceof ArrayBuffer) {
+      if (new Uint8Array(event.data)[0] === FRAME_CODE_BATCH) {
+        this.decodeCodeBatch(event.data).forEach((change) => this.updateCodeEditor(change));
+      }
+      return;
+    }
     try {
       const data = JSON.parse(event.data);
 
       if (data.type === "chat_message") {
         this.displayMessage(data.username, data.message);
+      } else if (data.type === "code_batch") {
+        data.ops.forEach((change) => this.updateCodeEditor(change));
       } else if (data.type === "code_change") {
         this.updateCodeEditor(data.code);
+      } else if (data.type === "code_sync") {
+        if (data.interned) this.interned = data.interned;
+        this.syncCodeEditor(data.code, data.seq);
+      } else if (data.type === "presence") {
+        this.online = data.online;
       }
     } catch (error) {
       console.error("Error parsing message:", error);
@@ -108,27 +250,75 @@ class RoomWebSocket {
   setupCodeEditorSync() {
     this.codeEditor.on("change", (instance, changeObj) => {
       if (this.lock) return;
-      this.sendCodeChange({
-        from: changeObj.from,
-        to: changeObj.to,
-        text: changeObj.text,
-        origin: changeObj.origin,
-        clientId: this.clientId,
-      });
+      this.flushCodeChanges(changeObj.origin);
     });
   }
 
+  flushCodeChanges(origin) {
+    if (this.inflight || this.serverText === null) return;
+    if (!this.socket || this.socket.readyState !== WebSocket.OPEN) return;
+    const op = diffText(this.serverText, this.codeEditor.getValue());
+    if (op.start === op.end && !op.text) return;
+    this.inflight = op;
+    this.sendCodeChange({
+      from: indexToPos(this.serverText, op.start),
+      to: indexToPos(this.serverText, op.end),
+      text: op.text.split("\n"),
+      origin: origin,
+      clientId: this.clientId,
+    });
+  }
+
+  syncCodeEditor(code, seq) {
+    // Also sent when our op was too old to transform; it is dropped
+    this.seq = seq;
+    this.serverText = code;
+    this.inflight = null;
+    if (this.codeEditor && this.codeEditor.getValue() !== code) {
+      this.setEditorText(code);
+    }
+  }
+
+  setEditorText(text) {
+    // Replace only what changed so the cursor stays where it was
+    const current = this.codeEditor.getValue();
+    const change = diffText(current, text);
+    this.lock = true;
+    this.codeEditor.replaceRange(
+      change.text,
+      indexToPos(current, change.start),
+      indexToPos(current, change.end)
+    );
+    this.lock = false;
+  }
+
   updateCodeEditor(change) {
-    if (this.codeEditor) {
-      if (this.clientId == change.clientId) return;
-      this.lock = true;
-      this.codeEditor.replaceRange(
-        change.text.join("\n"),
-        change.from,
-        change.to
-      );
-      this.lock = false;
+    // Already part of the document we synced from
+    if (!change.seq || change.seq <= this.seq || this.serverText === null) return;
+    const before = this.serverText;
+    let start = posToIndex(before, change.from);
+    let end = posToIndex(before, change.to);
+    if (end < start) [start, end] = [end, start];
+    const applied = { start, end, text: change.text.join("\n") };
+    this.serverText = applyOp(before, applied);
+    this.seq = change.seq;
+    if (!this.codeEditor) return;
+
+    if (change.clientId === this.clientId) {
+      // Our op is in the document now, send what was typed meanwhile
+      this.inflight = null;
+      this.flushCodeChanges();
+      return;
     }
+
+    // The server puts this op before our in-flight one and shifts ours past
+    // it; do the same here, then carry the unsent edits over on top
+    const oldBase = this.inflight ? applyOp(before, this.inflight) : before;
+    const unsent = diffText(oldBase, this.codeEditor.getValue());
+    if (this.inflight) this.inflight = transformOp(this.inflight, applied);
+    const newBase = this.inflight ? applyOp(this.serverText, this.inflight) : this.serverText;
+    const rebased = transformOp(unsent, diffText(oldBase, newBase));
+    this.setEditorText(applyOp(newBase, rebased));
   }
 }
 
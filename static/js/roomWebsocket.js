@@ -8,6 +8,8 @@ class RoomWebSocket {
         this.websocketMessageContainer = document.getElementById('websocket-messages');
         this.messageForm = document.getElementById('message-form');
         this.messageInput = document.getElementById('message-input');
+        this.olderCursor = typeof OLDER_CURSOR !== 'undefined' ? OLDER_CURSOR : '';
+        this.loadingOlder = false;
     }
 
     connect() {
@@ -19,6 +21,10 @@ class RoomWebSocket {
 
         this.socket.onopen = () => {
             console.log('WebSocket connection established');
+            // Keeps this socket counted as online, see base/presence.py
+            this.heartbeat = setInterval(() => {
+                this.socket.send(JSON.stringify({ 'type': 'heartbeat' }));
+            }, 20000);
         };
 
         this.socket.onmessage = (event) => {
@@ -28,10 +34,18 @@ class RoomWebSocket {
 
         this.socket.onclose = () => {
             console.log('WebSocket connection closed');
+            clearInterval(this.heartbeat);
             // Optional: Attempt to reconnect
             //setTimeout(() => this.connect(), 1000);
         };
 
+        // Fetch older pages of history when scrolled to the top
+        this.messageContainer.addEventListener('scroll', () => {
+            if (this.messageContainer.scrollTop === 0) {
+                this.loadOlderMessages();
+            }
+        });
+
         // Attach form submit event
         this.messageForm.addEventListener('submit', (e) => {
             e.preventDefault();
@@ -58,6 +72,10 @@ class RoomWebSocket {
     handleIncomingMessage(event) {
         try {
             const data = JSON.parse(event.data);
+            if (data.type === 'presence') {
+                this.updatePresence(data.online);
+                return;
+            }
             this.displayMessage(data.username, data.message);
         } catch (error) {
             console.error('Error parsing message:', error);
@@ -89,6 +107,59 @@ class RoomWebSocket {
         // Auto-scroll to bottom
         this.messageContainer.scrollTop = this.messageContainer.scrollHeight;
     }
+
+    updatePresence(online) {
+        const onlineIds = new Set(online.map((user) => String(user.id)));
+        document.querySelectorAll('.participant[data-user-id]').forEach((participant) => {
+            const avatar = participant.querySelector('.avatar');
+            avatar.classList.toggle('active', onlineIds.has(participant.dataset.userId));
+        });
+    }
+
+    async loadOlderMessages() {
+        if (!this.olderCursor || this.loadingOlder || typeof MESSAGES_URL === 'undefined') return;
+        this.loadingOlder = true;
+        try {
+            const res = await fetch(`${MESSAGES_URL}?before=${encodeURIComponent(this.olderCursor)}`);
+            const data = await res.json();
+            const previousHeight = this.messageContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach((message) => {
+                fragment.appendChild(this.buildHistoryMessage(message));
+            });
+            this.messageContainer.insertBefore(fragment, this.messageContainer.firstChild);
+            // Keep the message the user was looking at in place
+            this.messageContainer.scrollTop = this.messageContainer.scrollHeight - previousHeight;
+            this.olderCursor = data.next || '';
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            this.loadingOlder = false;
+        }
+    }
+
+    buildHistoryMessage(message) {
+        const messageElement = document.createElement('div');
+        messageElement.classList.add('thread');
+        messageElement.innerHTML = `
+            <div class="thread__top">
+                <div class="thread__author">
+                    <a href="/profile/${message.user_id}/" class="thread__authorInfo">
+                        <div class="avatar avatar--small">
+                            <img src="https://randomuser.me/api/portraits/men/37.jpg" />
+                        </div>
+                        <span></span>
+                    </a>
+                    <span class="thread__date"></span>
+                </div>
+            </div>
+            <div class="thread__details"></div>
+        `;
+        messageElement.querySelector('.thread__authorInfo span').textContent = `@${message.username}`;
+        messageElement.querySelector('.thread__date').textContent = new Date(message.created).toLocaleString();
+        messageElement.querySelector('.thread__details').textContent = message.body;
+        return messageElement;
+    }
 }
 
 // Initialize WebSocket on page load